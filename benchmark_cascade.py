@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+カスケード検索（軽量モデル → ResNet-50）と ResNet-50 のみの検索を比較するスクリプト
+
+同じ画像群を両方の方式で検索し、処理時間の比（高速化率）と、
+ResNet-50 のみでマッチした画像のうちカスケードで見逃した割合（見逃し率）を表示する。
+
+処理時間は2通り計測する。
+- End-to-end: 本番のスキャンと同じ読み込み経路（先読みを含む）でファイルを読み、デコード・推論・検索するまで
+- Compute-only: 画像のバイト列をメモリに読み込んだ後の、デコード・推論・検索だけ
+
+End-to-end は両方式ともページキャッシュが温まった状態で計測する（最初の読み込みで温まる）。
+NFS などでキャッシュが効かない場合の I/O 待ちは本番のスキャンのログで確認すること。
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+from image_sources import iter_image_sources, read_image_bytes, prefetch_image_sources
+from image_similarity_faiss import (
+    FeatureExtractor, MAX_IMAGE_FILE_SIZE, CASCADE_MODEL, CASCADE_WEIGHTS_PATH, CASCADE_TOLERANCE,
+    ENABLE_READ_AHEAD, READ_AHEAD_DEPTH, READ_AHEAD_WORKERS, READ_AHEAD_MAX_BYTES,
+    build_excluded_dirs, collect_search_image_paths, resolve_target_sets, build_target_set,
+    build_cascade_index, cascade_filter, compute_embeddings_for_list,
+)
+
+DEFAULT_SAMPLE_SIZE = 1000
+
+def find_matches(target_sets, embeddings, paths):
+    """各Target画像セットの閾値でマッチした (セット名, パス) の集合"""
+    matches = set()
+    if embeddings.shape[0] == 0:
+        return matches
+    for target_set in target_sets:
+        D, _ = target_set['index'].search(embeddings, 1)
+        for path, sim in zip(paths, D[:, 0]):
+            if sim >= target_set['tolerance']:
+                matches.add((target_set['name'], path))
+    return matches
+
+def load_sources(paths):
+    """Compute-only の計測用に、画像のバイト列を先にすべて読み込む"""
+    sources = []
+    for path, data in iter_image_sources(paths, max_member_size=MAX_IMAGE_FILE_SIZE):
+        if data is None:
+            try:
+                data = read_image_bytes(path)
+            except OSError:
+                continue
+        sources.append((path, data))
+    return sources
+
+def scan_sources(paths):
+    """本番のスキャンと同じ経路で (パス, バイト列) を読み出す（先読みが有効ならスレッドで先読み）"""
+    sources = iter_image_sources(paths, max_member_size=MAX_IMAGE_FILE_SIZE)
+    if ENABLE_READ_AHEAD:
+        sources = prefetch_image_sources(
+            sources, depth=READ_AHEAD_DEPTH, workers=READ_AHEAD_WORKERS,
+            max_bytes=READ_AHEAD_MAX_BYTES, max_file_size=MAX_IMAGE_FILE_SIZE,
+        )
+    return sources
+
+def run_full(target_sets, extractor, paths, sources):
+    """ResNet-50 のみで検索し、(マッチ, 処理時間) を返す"""
+    start = time.perf_counter()
+    embeddings, valid_paths = compute_embeddings_for_list(paths, extractor, sources=sources)
+    matches = find_matches(target_sets, embeddings, valid_paths)
+    return matches, time.perf_counter() - start
+
+def run_cascade(target_sets, extractor, cascade_extractor, paths, sources):
+    """カスケードで検索し、(マッチ, ResNet-50 に通した画像数, 処理時間) を返す
+
+    本番のスキャンと同じく、読み込んだバイト列を通過した画像の ResNet-50 でも使い回す。
+    """
+    start = time.perf_counter()
+    buffered = []  # [(パス, バイト列, 軽量モデルの埋め込み), ...]
+    for path, data in sources:
+        feats = cascade_extractor.extract(path, data=data)
+        if feats is not None:
+            buffered.append((path, data, feats))
+    candidates = []
+    if buffered:
+        passed = cascade_filter(target_sets, np.vstack([feats for _, _, feats in buffered]))
+        candidates = [(path, data) for (path, data, _), ok in zip(buffered, passed) if ok]
+    embeddings, valid_paths = compute_embeddings_for_list(
+        [path for path, _ in candidates], extractor, sources=candidates
+    )
+    matches = find_matches(target_sets, embeddings, valid_paths)
+    return matches, len(candidates), time.perf_counter() - start
+
+def format_speedup(full_time, cascade_time):
+    return f"{full_time / cascade_time:.2f}x" if cascade_time > 0 else "n/a"
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python benchmark_cascade.py <検索対象ディレクトリ> [サンプル数]")
+        sys.exit(1)
+    search_root = sys.argv[1]
+    sample_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SAMPLE_SIZE
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    print("=" * 60)
+    print("⏱️  Cascade benchmark")
+    print("=" * 60)
+
+    extractor = FeatureExtractor()
+    cascade_extractor = FeatureExtractor(model_name=CASCADE_MODEL, weights_path=CASCADE_WEIGHTS_PATH)
+    target_set_configs = resolve_target_sets(script_dir)
+    target_sets = [t for t in (build_target_set(c, extractor) for c in target_set_configs) if t is not None]
+    if not target_sets:
+        print("❌ No usable target sets.")
+        sys.exit(1)
+    for target_set in target_sets:
+        if not build_cascade_index(target_set, cascade_extractor):
+            sys.exit(1)
+
+    search_image_paths, _ = collect_search_image_paths(
+        search_root, build_excluded_dirs(search_root), skip_dirs=[c['dir'] for c in target_set_configs]
+    )
+    search_image_paths = search_image_paths[:sample_size]
+    print(f"📥 Loading {len(search_image_paths)} images into memory...")
+    start = time.perf_counter()
+    sources = load_sources(search_image_paths)
+    load_time = time.perf_counter() - start
+    paths = [path for path, _ in sources]
+
+    # 1. End-to-end（ファイルの読み込みから）
+    print("🐢 [end-to-end] ResNet-50 only...")
+    full_matches, e2e_full_time = run_full(target_sets, extractor, paths, scan_sources(paths))
+    print(f"🐇 [end-to-end] Cascade ({CASCADE_MODEL} → ResNet-50)...")
+    cascade_matches, passed_count, e2e_cascade_time = run_cascade(
+        target_sets, extractor, cascade_extractor, paths, scan_sources(paths))
+
+    # 2. Compute-only（メモリ上のバイト列から）
+    print("🐢 [compute-only] ResNet-50 only...")
+    _, full_time = run_full(target_sets, extractor, paths, sources)
+    print(f"🐇 [compute-only] Cascade ({CASCADE_MODEL} → ResNet-50)...")
+    _, _, cascade_time = run_cascade(target_sets, extractor, cascade_extractor, paths, sources)
+
+    missed = full_matches - cascade_matches
+    print("=" * 60)
+    print(f"📊 Images: {len(paths)}  (cascade threshold: {CASCADE_TOLERANCE}, "
+          f"read-ahead: {ENABLE_READ_AHEAD}, initial load: {load_time:.1f}s)")
+    print(f"   - Passed to ResNet-50: {passed_count}/{len(paths)}")
+    print(f"   - End-to-end (read + decode + inference, warm cache):")
+    print(f"       ResNet-50 only: {e2e_full_time:.1f}s, {len(full_matches)} matches")
+    print(f"       Cascade: {e2e_cascade_time:.1f}s, {len(cascade_matches)} matches")
+    print(f"       Speedup: {format_speedup(e2e_full_time, e2e_cascade_time)}")
+    print(f"   - Compute-only (decode + inference, bytes preloaded):")
+    print(f"       ResNet-50 only: {full_time:.1f}s / Cascade: {cascade_time:.1f}s")
+    print(f"       Speedup: {format_speedup(full_time, cascade_time)}")
+    if full_matches:
+        print(f"   - Miss rate: {len(missed)}/{len(full_matches)} ({100 * len(missed) / len(full_matches):.1f}%)")
+    else:
+        print("   - Miss rate: n/a (no matches with ResNet-50 only)")
+    for name, path in sorted(missed):
+        print(f"   ⚠️  Missed [{name}]: {path}")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+共有用ZIPファイルを作成するスクリプト
+
+実行結果のHTMLレポートが実際に参照している画像と、マッチした画像だけを
+一時ディレクトリにコピーせずに直接ZIPへ書き込む。HTML内の画像パスは書き込み時に
+ZIP内の配置に合わせて書き換える。
+
+使用方法:
+    python create_share_bundle.py [タイムスタンプ] [--originals matched|all|none]
+
+    --originals matched  マッチした画像（とそのTarget画像）は原寸、それ以外はサムネイル（デフォルト）
+    --originals all      参照されている画像をすべて原寸で含める
+    --originals none     すべてサムネイルで含める
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import zipfile
+from urllib.parse import unquote, quote
+
+from PIL import Image
+
+import results_store
+from image_sources import is_virtual_path, read_image_bytes, get_source_size
+from result_table import TABLE_DIR_NAME, load_result_table
+
+THUMBNAIL_SIZE = (240, 240)
+THUMBNAIL_CACHE_DIR = ".thumbnail_cache"  # output/ 以下に作成（実行をまたいで再利用）
+COPY_CHUNK_SIZE = 1024 * 1024
+RUN_FILE_PATTERNS = ("*.html", "*.log", "matches.*")
+SEARCH_ROOT_LOG_PREFIX = "- Search Root:"  # image_similarity_faiss.py の設定表示
+THUMBNAIL_SUFFIX = ".thumb.jpg"  # サムネイルは JPEG なので元の名前に付けて格納する
+
+SRC_PATTERN = re.compile(r'src="([^"]+)"')
+
+def find_latest_run(output_root):
+    timestamps = sorted(
+        (name for name in os.listdir(output_root) if re.fullmatch(r"\d{8}_\d{6}", name)),
+        reverse=True,
+    ) if os.path.isdir(output_root) else []
+    return timestamps[0] if timestamps else None
+
+def load_run_info(script_dir, run_dir, timestamp):
+    """検索対象ディレクトリ・Targetディレクトリ・マッチ一覧を実行履歴ストア（なければログ）から取得"""
+    search_root = None
+    target_dirs = [os.path.join(script_dir, "target")]
+    matched_paths = set()
+
+    db_path = results_store.default_db_path(script_dir)
+    if os.path.exists(db_path):
+        conn = results_store.connect(db_path)
+        run = results_store.get_run(conn, timestamp)
+        if run:
+            search_root = run['search_root']
+            params = json.loads(run["params"] or "{}")
+            target_dirs += [t['dir'] for t in params.get('target_sets', [])]
+            for row in conn.execute(
+                    "SELECT corpus_path, target_path FROM matches WHERE run_id = ?", (timestamp,)):
+                matched_paths.add(row['corpus_path'])
+                matched_paths.add(row['target_path'])
+        conn.close()
+
+    if search_root is None and os.path.isdir(os.path.join(run_dir, TABLE_DIR_NAME)):
+        search_root = load_result_table(run_dir)['meta']['search_root']
+
+    if search_root is None:
+        # 古い実行結果はログから検索対象ディレクトリを取得
+        # （run_search.sh の「検索対象:」は tee の前に出力されるのでログには残らない。
+        #   image_similarity_faiss.py が出力する設定一覧の行を使う）
+        log_path = os.path.join(run_dir, "search_log.log")
+        if os.path.exists(log_path):
+            with open(log_path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if SEARCH_ROOT_LOG_PREFIX in line:
+                        # run_search.sh はスクリプトのディレクトリで実行するので、相対パスはそこからの相対
+                        search_root = os.path.abspath(
+                            os.path.join(script_dir, line.split(SEARCH_ROOT_LOG_PREFIX, 1)[1].strip()))
+                        break
+
+    return search_root, [os.path.abspath(d) for d in target_dirs], matched_paths
+
+class BundleLayout:
+    """元の画像パス → ZIP内の配置"""
+
+    def __init__(self, script_dir, search_root, target_dirs):
+        self.script_dir = script_dir
+        self.search_root = os.path.abspath(search_root) if search_root else None
+        self.target_dirs = target_dirs
+
+    def arcname(self, path):
+        abs_path = os.path.abspath(path)
+        # アーカイブ内メンバーはアーカイブ名のディレクトリ配下に置く
+        abs_path = abs_path.replace("!/", "/")
+        for target_dir in self.target_dirs:
+            if abs_path.startswith(target_dir + os.sep):
+                return os.path.relpath(abs_path, self.script_dir).replace(os.sep, "/")
+        if self.search_root and abs_path.startswith(self.search_root + os.sep):
+            rel_path = os.path.relpath(abs_path, self.search_root)
+            return f"{os.path.basename(self.search_root)}/{rel_path}".replace(os.sep, "/")
+        digest = hashlib.sha1(os.path.dirname(abs_path).encode('utf-8')).hexdigest()[:12]
+        return f"external/{digest}/{os.path.basename(abs_path)}"
+
+def thumbnail_path(cache_dir, path):
+    """サムネイルのキャッシュパス（元画像のパス・サイズ・更新日時が同じなら再利用）"""
+    archive_path = path.split("!/", 1)[0]
+    stat = os.stat(archive_path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".jpg")
+
+def ensure_thumbnail(cache_dir, path):
+    cached = thumbnail_path(cache_dir, path)
+    if not os.path.exists(cached):
+        source = io.BytesIO(read_image_bytes(path)) if is_virtual_path(path) else path
+        with Image.open(source) as img:
+            img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+            if img.mode != "RGB":
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.split()[-1])
+            tmp_path = cached + ".tmp"
+            img.save(tmp_path, format="JPEG", quality=80)
+            os.replace(tmp_path, cached)
+    return cached
+
+def write_file(zf, arcname, path, compress):
+    """ファイルを一時コピーせずにZIPへ書き込む"""
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+def write_image(zf, arcname, path):
+    if is_virtual_path(path):
+        zf.writestr(zipfile.ZipInfo(arcname, date_time=time.localtime()[:6]), read_image_bytes(path))
+    else:
+        # 画像は圧縮済みなので無圧縮で格納する
+        write_file(zf, arcname, path, compress=False)
+
+def main():
+    parser = argparse.ArgumentParser(description="共有用ZIPファイルを作成します")
+    parser.add_argument("timestamp", nargs="?", help="実行結果のタイムスタンプ（省略時は最新）")
+    parser.add_argument("--originals", choices=("matched", "all", "none"), default="matched",
+                        help="原寸で含める画像（それ以外はサムネイル）")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output_root = os.path.join(script_dir, "output")
+    timestamp = args.timestamp or find_latest_run(output_root)
+    if not timestamp:
+        print("❌ outputディレクトリに実行結果が見つかりません")
+        sys.exit(1)
+    if not args.timestamp:
+        print(f"📁 最新の実行結果を使用: {timestamp}")
+    run_dir = os.path.join(output_root, timestamp)
+    if not os.path.isdir(run_dir):
+        print(f"❌ ディレクトリが見つかりません: {run_dir}")
+        sys.exit(1)
+
+    zip_path = os.path.join(output_root, f"share_result_{timestamp}.zip")
+    cache_dir = os.path.join(output_root, THUMBNAIL_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    print("=" * 60)
+    print("📦 共有用ZIPファイル作成")
+    print("=" * 60)
+    print(f"実行結果: {run_dir}")
+    print(f"出力先: {zip_path}")
+    print("=" * 60)
+
+    start = time.perf_counter()
+    search_root, target_dirs, matched_paths = load_run_info(script_dir, run_dir, timestamp)
+    if search_root is None:
+        print("⚠️  検索対象ディレクトリが特定できません。検索画像のパスは external/ に配置します。")
+    layout = BundleLayout(script_dir, search_root, target_dirs)
+    run_arc_dir = f"output/{timestamp}"
+
+    run_files = sorted({
+        path for pattern in RUN_FILE_PATTERNS for path in glob.glob(os.path.join(run_dir, pattern))
+    })
+
+    def use_original(path):
+        return args.originals == "all" or (args.originals == "matched" and path in matched_paths)
+
+    def arcname_for(path):
+        # サムネイルは JPEG で格納するので、拡張子と中身が食い違わない名前にする
+        arcname = layout.arcname(path)
+        return arcname if use_original(path) else arcname + THUMBNAIL_SUFFIX
+
+    # HTMLが参照している画像を集め、パスをZIP内の配置に書き換える
+    referenced = {}  # {元の絶対パス: ZIP内のパス}
+    rewritten_html = {}
+
+    def rewrite_src(match):
+        src = match.group(1)
+        if src.startswith(("data:", "http://", "https://")):
+            return match.group(0)
+        abs_path = os.path.normpath(os.path.join(run_dir, unquote(src)))
+        if not os.path.exists(abs_path.split("!/", 1)[0]):
+            return match.group(0)
+        arcname = arcname_for(abs_path)
+        referenced[abs_path] = arcname
+        return f'src="{quote(os.path.relpath(arcname, run_arc_dir).replace(os.sep, "/"))}"'
+
+    for path in run_files:
+        if path.endswith(".html"):
+            with open(path, encoding='utf-8') as f:
+                rewritten_html[path] = SRC_PATTERN.sub(rewrite_src, f.read())
+
+    # マッチした画像はHTMLから参照されていなくても原寸で含める
+    for path in matched_paths:
+        if os.path.exists(path.split("!/", 1)[0]):
+            referenced.setdefault(path, arcname_for(path))
+
+    original_count = 0
+    thumbnail_count = 0
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for path in run_files:
+            arcname = f"{run_arc_dir}/{os.path.basename(path)}"
+            if path in rewritten_html:
+                zf.writestr(arcname, rewritten_html[path])
+            else:
+                write_file(zf, arcname, path, compress=True)
+
+        for path, arcname in sorted(referenced.items(), key=lambda item: item[1]):
+            try:
+                if use_original(path):
+                    write_image(zf, arcname, path)
+                    original_count += 1
+                else:
+                    write_file(zf, arcname, ensure_thumbnail(cache_dir, path), compress=False)
+                    thumbnail_count += 1
+            except Exception as e:
+                print(f"⚠️  Failed to add {path}: {e}")
+
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(zip_path)
+    source_size = 0
+    for path in referenced:
+        try:
+            source_size += get_source_size(path)
+        except Exception:
+            pass
+
+    print("")
+    print("=" * 60)
+    print("✅ ZIPファイル作成完了！")
+    print("=" * 60)
+    print(f"📄 レポート・ログ: {len(run_files)} ファイル")
+    print(f"🖼️  画像: 原寸 {original_count} 枚 / サムネイル {thumbnail_count} 枚"
+          f"（参照画像の元サイズ合計 {source_size / (1024 * 1024):.1f} MB）")
+    print(f"📦 サイズ: {size / (1024 * 1024):.1f} MB")
+    print(f"⏱️  作成時間: {elapsed:.1f}s")
+    print(f"出力先: {zip_path}")
+    print("")
+    print("📤 Google Driveにアップロードして共有してください。")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,12 @@ import os
 import sys
 import glob
 import time
-import webbrowser
 from datetime import datetime
-import base64
 import io
+import itertools
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageSequence
 
 import torch
 import torch.nn as nn
@@ -18,9 +17,16 @@ import torchvision.models as models
 
 import faiss  # pip install faiss-cpu
 
-# Google Sheets連携は無効化されています
-# import gspread
-# from google.oauth2.service_account import Credentials
+from image_sources import (
+    is_archive, is_virtual_path, list_archive_images, iter_image_sources, order_for_streaming,
+    open_image_source, get_source_size, prefetch_image_sources, ReadStats,
+)
+from result_table import ResultTableWriter
+from result_exporters import create_exporters, ExportQueue
+import results_store
+from report import (
+    DEFAULT_TARGET_SET, get_output_dir, generate_html_report, print_similarity_statistics, report_name_for,
+)
 
 # ========================================
 # 設定変数（ここで変更してください）
@@ -31,220 +37,74 @@ MAX_TARGET_IMAGES = None  # Target画像の最大数（None = 全て使用）
 
 TOP_K = 5  # FAISS が返す上位 K 件（候補数）。最も類似な1件を使うなら1で可
 
+# 複数のTarget画像セット（None = target/ を TOLERANCE で検索）
+# セットごとにインデックスと閾値を持ち、検索画像の特徴抽出は1回だけで全セットと照合する
+# 例:
+# TARGET_SETS = {
+#     "logos": {"dir": "targets/logos", "tolerance": 0.90},
+#     "deprecated": {"dir": "targets/deprecated", "tolerance": 0.85},
+#     "stock": {"dir": "targets/stock"},  # tolerance 省略時は TOLERANCE
+# }
+TARGET_SETS = None
+SEARCH_BATCH_SIZE = 64  # 何枚分の埋め込みをまとめてFAISS検索するか
+
+# タイル検索（大きな画像の中に埋め込まれたTarget画像を探す）
+ENABLE_TILED_SEARCH = False  # True: 画像全体に加えて格子状タイルごとにも特徴抽出する
+TILE_GRID_LEVELS = (2, 3)  # ピラミッドの各段の分割数（2 = 2x2, 3 = 3x3）
+TILE_OVERLAP = 0.5  # 隣り合うタイルの重なり率（0.0〜0.9）
+MAX_TILES_PER_IMAGE = 36  # 1画像あたりのタイル数の上限（画像全体を含む、収まらない段は使わない）
+MIN_TILE_SIZE = 64  # これより小さいタイルは作らない（px）
+TILE_BATCH_SIZE = 64  # 何タイル分まとめてバックボーンに通すか
+
+# カスケード検索（軽量モデルで候補を絞り込んでから ResNet-50 で最終判定）
+ENABLE_CASCADE = False  # True: 全画像を軽量モデルで検索し、通過した画像だけ ResNet-50 に通す
+CASCADE_MODEL = "resnet18"  # torchvision のモデル名（resnet18, mobilenet_v3_small など）
+CASCADE_WEIGHTS_PATH = None  # ローカルの重みファイル（None = torchvision の学習済み重み）
+CASCADE_TOLERANCE = 0.75  # 軽量モデルでの通過閾値（見逃しを防ぐため TOLERANCE より緩くする）
+
+# フレームサンプリング（アニメーションGIF / APNG / WebP、マルチページTIFF）
+ENABLE_FRAME_SAMPLING = False  # True: 先頭フレームだけでなく場面の変わり目のフレームも特徴抽出する
+MAX_FRAMES = 16  # 1画像あたりに使うフレーム数の上限（先頭フレームを含む）
+FRAME_CHANGE_THRESHOLD = 0.08  # 直前のフレームとの平均輝度差（0〜1）がこれ以上なら場面の変わり目とみなす
+
 # Google Sheets設定
 SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1opng3SCJc4aJbGnXLB7wGc2NNQYnCe6nGtPRPgjackc/edit?gid=0#gid=0"
 SPREADSHEET_ID = "1opng3SCJc4aJbGnXLB7wGc2NNQYnCe6nGtPRPgjackc"
+SHEETS_CREDENTIALS_FILE = "credentials.json"  # スクリプトと同じディレクトリに配置
+SHEETS_SHEET_NAME = None  # 書き込むシート名（None = 最初のシート。日本語ロケールでは「シート1」）
+SHEETS_API_URL = "https://sheets.googleapis.com/v4"  # 動作確認時はローカルのスタブサーバーのURLに変更
 
 # その他の設定
 IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff", ".webp")
-BATCH_SIZE = 25
-ENABLE_SPREADSHEET = False  # Google Sheets連携を無効化
+MAX_IMAGE_FILE_SIZE = 50 * 1024 * 1024  # これより大きい画像はスキップ
+ENABLE_ARCHIVE_SEARCH = True  # zip/tar 内の画像も展開せずに検索する
+
+# 先読み設定（NFS/SMB やクラウド同期ディスク向け）
+ENABLE_READ_AHEAD = True  # 次の画像のファイル読み込みをスレッドで並行して行う
+READ_AHEAD_DEPTH = 16  # 先読みする画像の数
+READ_AHEAD_WORKERS = 8  # 同時に読み込むスレッド数
+READ_AHEAD_MAX_BYTES = 256 * 1024 * 1024  # 先読み中・先読み済みバッファの合計上限（バイト）
+ENABLE_SPREADSHEET = False  # Google Sheets連携を無効化（True にすると EXPORT_FORMATS に "sheets" を追加）
+# マッチの出力形式（スキャンと並行して output/<ts>/matches.* に書き出す）
+# "csv", "jsonl", "parquet"（pyarrow が必要）, "sheets"（google-auth[requests] と credentials.json が必要）
+EXPORT_FORMATS = ()
 ENABLE_HTML_REPORT = True
+ENABLE_RESULT_TABLE = True  # 全検索画像の上位K件を保存し、rethreshold_results.py で再集計できるようにする
+ENABLE_RESULTS_STORE = True  # 実行のパラメータ・処理時間・マッチを output/results.sqlite3 に記録する
 
 # ========================================
 
-SCOPES = [
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive'
-]
-
-def setup_google_sheets():
-    try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        credentials_path = os.path.join(script_dir, "credentials.json")
-        if not os.path.exists(credentials_path):
-            print(f"❌ Google Service Account credentials file not found: {credentials_path}")
-            print("Skipping Google Sheets output.")
-            return None
-        credentials = Credentials.from_service_account_file(credentials_path, scopes=SCOPES)
-        client = gspread.authorize(credentials)
-        spreadsheet = client.open_by_key(SPREADSHEET_ID)
-        worksheet = spreadsheet.sheet1
-        return worksheet
-    except Exception as e:
-        print(f"❌ Error setting up Google Sheets: {e}")
-        return None
-
-def clear_spreadsheet(worksheet):
-    try:
-        worksheet.clear()
-        time.sleep(2)
-        return True
-    except Exception as e:
-        print(f"❌ Error clearing spreadsheet: {e}")
-        return False
-
-def write_to_sheet_batch(worksheet, results, batch_size=BATCH_SIZE):
-    try:
-        if not clear_spreadsheet(worksheet):
-            print("⚠️  Failed to clear spreadsheet, but continuing...")
-        headers = ["対象画像", "マッチした画像パス", "Similarity"]
-        worksheet.update(values=[headers], range_name='A1:C1')
-        time.sleep(2)
-        if not results:
-            return True
-        total_batches = (len(results) + batch_size - 1) // batch_size
-        for i in range(0, len(results), batch_size):
-            batch = results[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            batch_data = []
-            for result in batch:
-                row = [
-                    result['target_image'],
-                    result['matched_path'],
-                    result['similarity']
-                ]
-                batch_data.append(row)
-            if batch_data:
-                start_row = 2 + i
-                end_row = start_row + len(batch_data) - 1
-                range_name = f"A{start_row}:C{end_row}"
-                try:
-                    worksheet.update(values=batch_data, range_name=range_name)
-                    if batch_num < total_batches:
-                        time.sleep(2)
-                except Exception as batch_error:
-                    print(f"❌ Error writing batch {batch_num}: {batch_error}")
-                    time.sleep(5)
-                    continue
-        return True
-    except Exception as e:
-        print(f"❌ Error writing to spreadsheet: {e}")
-        return False
-
-def image_to_base64(image_path, max_size=(150, 112)):
-    """画像をサムネイル化してBase64エンコード"""
-    try:
-        img = Image.open(image_path)
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buffered = io.BytesIO()
-        # RGBに変換（PNGやGIFの透過対応）
-        if img.mode in ('RGBA', 'LA', 'P'):
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = rgb_img
-        img.save(buffered, format="JPEG", quality=75)
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        return f"data:image/jpeg;base64,{img_str}"
-    except Exception as e:
-        print(f"⚠️  Failed to encode {image_path}: {e}")
-        return ""
-
-def generate_html_report(results):
-    print("📄 Generating HTML report with embedded images...")
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Image Similarity Results (FAISS)</title>
-        <meta charset="UTF-8">
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }}
-            .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 10px; margin-bottom: 30px; }}
-            .summary {{ background: white; padding: 15px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); margin-bottom: 20px; }}
-            .result {{ background: white; margin: 20px 0; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .images {{ display: flex; gap: 30px; align-items: flex-start; flex-wrap: wrap; }}
-            .image-container {{ text-align: center; flex: 1; min-width: 250px; }}
-            .image-container img {{ max-width: 200px; max-height: 200px; }}
-            .image-path {{ font-size: 12px; color: #666; word-break: break-all; margin-top: 5px; background: #f8f9fa; padding: 5px; border-radius: 4px; }}
-            .distance {{ font-size: 20px; font-weight: bold; margin: 10px 0; padding: 10px; border-radius: 5px; text-align: center; background: #2196F3; color: white; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>🔍 Image Similarity Results (FAISS)</h1>
-            <p>Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
-        </div>
-
-        <div class="summary">
-            <h2>📊 Summary</h2>
-            <p>Total Matches: {len(results)}</p>
-            <p>Tolerance (similarity threshold): {TOLERANCE}</p>
-        </div>
-    """
-    # パスを簡略化する関数
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    def simplify_path(path):
-        """絶対パスを /target/... や /検索dir/... の形式に簡略化"""
-        abs_path = os.path.abspath(path)
-        # targetディレクトリの場合
-        if '/target/' in abs_path:
-            return '/target/' + abs_path.split('/target/')[-1]
-        # 検索対象ディレクトリの場合（プロジェクトルートの親ディレクトリ内）
-        parent_dir = os.path.dirname(script_dir)
-        if parent_dir in abs_path and script_dir not in abs_path:
-            # 親ディレクトリからの相対パスを取得
-            rel_path = os.path.relpath(abs_path, parent_dir)
-            return '/' + rel_path
-        # その他の場合はファイル名のみ
-        return os.path.basename(abs_path)
-
-    for i, result in enumerate(results, 1):
-        sim = float(result['similarity'])
-        # 画像をBase64エンコード
-        target_base64 = image_to_base64(result['target_image_path'])
-        matched_base64 = image_to_base64(result['matched_path'])
-
-        # パス表示を簡略化
-        target_display_path = simplify_path(result['target_image_path'])
-        matched_display_path = simplify_path(result['matched_path'])
-
-        html_content += f"""
-        <div class="result">
-            <h3>Match #{i} - Similarity: {sim:.3f}</h3>
-            <div class="images">
-                <div class="image-container">
-                    <h4>Target</h4>
-                    <img src="{target_base64}" alt="Target Image">
-                    <div class="image-path">{target_display_path}</div>
-                </div>
-                <div class="image-container">
-                    <h4>Matched</h4>
-                    <img src="{matched_base64}" alt="Matched Image">
-                    <div class="image-path">{matched_display_path}</div>
-                </div>
-            </div>
-        </div>
-        """
-    html_content += """
-        <div style="text-align:center; margin:40px 0; padding:20px; background:white; border-radius:10px;">
-            <h3>🎉 Report Generated Successfully!</h3>
-            <p>このHTMLファイルは画像を埋め込んでいるため、単体で共有可能です。</p>
-        </div>
-    </body>
-    </html>
-    """
-    # 実行日時ごとのoutputディレクトリを作成
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    # 環境変数からタイムスタンプを取得（run_search.shから渡される）
-    timestamp = os.environ.get('OUTPUT_TIMESTAMP', datetime.now().strftime('%Y%m%d_%H%M%S'))
-    output_dir = os.path.join(script_dir, "output", timestamp)
-    os.makedirs(output_dir, exist_ok=True)
-
-    report_path = os.path.join(output_dir, f"image_similarity_faiss_report.html")
-    try:
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        try:
-            file_url = f"file://{os.path.abspath(report_path)}"
-            webbrowser.open(file_url)
-        except Exception:
-            pass
-        print(f"✅ HTML report generated: {report_path}")
-        return report_path
-    except Exception as e:
-        print(f"❌ Error generating HTML report: {e}")
-        return None
-
 # --------- 特徴抽出 ----------
 class FeatureExtractor:
-    def __init__(self, device=None):
+    def __init__(self, device=None, model_name="resnet50", weights_path=None):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-        model = models.resnet50(pretrained=True)
-        modules = list(model.children())[:-1]
-        self.backbone = nn.Sequential(*modules).to(self.device)
+        self.model_name = model_name
+        if model_name == "resnet50" and weights_path is None:
+            model = models.resnet50(pretrained=True)
+            modules = list(model.children())[:-1]
+            self.backbone = nn.Sequential(*modules).to(self.device)
+        else:
+            self.backbone = self._build_backbone(model_name, weights_path).to(self.device)
         self.backbone.eval()
         self.transform = T.Compose([
             T.Resize(256),
@@ -253,30 +113,109 @@ class FeatureExtractor:
             T.Normalize(mean=[0.485, 0.456, 0.406],
                         std=[0.229, 0.224, 0.225])
         ])
+        # タイルは切り出した領域全体を使う（中央切り抜きで端を落とさない）
+        self.tile_transform = T.Compose([
+            T.Resize((224, 224)),
+            T.ToTensor(),
+            T.Normalize(mean=[0.485, 0.456, 0.406],
+                        std=[0.229, 0.224, 0.225])
+        ])
         for p in self.backbone.parameters():
             p.requires_grad = False
+        # 特徴ベクトルの次元数（モデルによって異なる）
+        with torch.no_grad():
+            self.dim = self.backbone(torch.zeros(1, 3, 224, 224, device=self.device)).flatten(1).shape[1]
+
+    @staticmethod
+    def _build_backbone(model_name, weights_path=None):
+        """torchvision のモデルから分類層を除いた特徴抽出器を作成"""
+        model = getattr(models, model_name)(pretrained=weights_path is None)
+        if weights_path is not None:
+            model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+        # 分類層を恒等写像に置き換え、プーリング後の特徴をそのまま出力する
+        if hasattr(model, "fc"):
+            model.fc = nn.Identity()
+        elif hasattr(model, "classifier"):
+            model.classifier = nn.Identity()
+        else:
+            raise ValueError(f"Unsupported backbone: {model_name}")
+        return model
+
+    def _open_image(self, image_path, data=None):
+        """画像を開く（大きすぎる画像は None。デコードはまだ行わない）"""
+        # バイト列のないアーカイブ内メンバーは、読み出し時に上限超過・読み込み失敗だったもの。
+        # アーカイブを開き直して（圧縮 tar なら全体を展開し直して）再度読むことはしない
+        if data is None and is_virtual_path(image_path):
+            return None
+        # 画像ファイルのサイズチェック（大きすぎる場合はスキップ）
+        file_size = len(data) if data is not None else get_source_size(image_path)
+        if file_size > MAX_IMAGE_FILE_SIZE:  # 50MB以上はスキップ
+            return None
+
+        source = io.BytesIO(data) if data is not None else open_image_source(image_path)
+        img = Image.open(source)
+
+        # 画像サイズチェック（大きすぎる場合はスキップ）
+        if img.width > 10000 or img.height > 10000:
+            img.close()
+            return None
+        return img
 
-    def extract(self, image_path):
+    def _load_image(self, image_path, data=None):
+        """画像をRGBで読み込む（大きすぎる画像は None）"""
+        img = self._open_image(image_path, data)
+        if img is None:
+            return None
+        with img:
+            return img.convert("RGB")
+
+    def _load_frames(self, image_path, data=None):
+        """複数フレーム画像から場面の変わり目のフレームを最大 MAX_FRAMES 枚選び、RGBで読み込む
+
+        ([(フレーム番号, 画像), ...], 総フレーム数) を返す（大きすぎる画像は ([], 0)）。
+        まず全フレームについて直前のフレームとの差を計算し、差が FRAME_CHANGE_THRESHOLD 以上の
+        フレームのうち差の大きい順に MAX_FRAMES - 1 枚と先頭フレームを選ぶ
+        （長いアニメーションでも後半の場面を取りこぼさない）。選んだフレームだけを RGB で保持する。
+        """
+        img = self._open_image(image_path, data)
+        if img is None:
+            return [], 0
+        with img:
+            frame_count = getattr(img, "n_frames", 1)
+            # 1回目: 全フレームの変化量（保持するのは縮小した比較用画像だけ）
+            changes = []  # [(変化量, フレーム番号), ...]
+            last_signature = None
+            for index, frame in enumerate(ImageSequence.Iterator(img)):
+                signature = frame_signature(frame.convert("RGB"))
+                if last_signature is not None:
+                    change = float(np.mean(np.abs(signature - last_signature)))
+                    if change >= FRAME_CHANGE_THRESHOLD:
+                        changes.append((change, index))
+                last_signature = signature
+            selected = {0} | {index for _, index in sorted(changes, reverse=True)[:max(0, MAX_FRAMES - 1)]}
+
+            # 2回目: 選んだフレームだけ RGB で読み込む
+            frames = []
+            for index, frame in enumerate(ImageSequence.Iterator(img)):
+                if index in selected:
+                    frames.append((index, frame.convert("RGB")))
+                if len(frames) == len(selected):
+                    break
+        return frames, frame_count
+
+    def extract(self, image_path, data=None):
+        """画像の特徴ベクトルを抽出（data にバイト列が渡された場合はそこからデコード）"""
         img = None
         x = None
         try:
-            # 画像ファイルのサイズチェック（大きすぎる場合はスキップ）
-            file_size = os.path.getsize(image_path)
-            if file_size > 50 * 1024 * 1024:  # 50MB以上はスキップ
-                return None
-
-            img = Image.open(image_path).convert("RGB")
-
-            # 画像サイズチェック（大きすぎる場合はスキップ）
-            if img.width > 10000 or img.height > 10000:
-                if img:
-                    img.close()
+            img = self._load_image(image_path, data)
+            if img is None:
                 return None
 
             x = self.transform(img).unsqueeze(0).to(self.device)
             with torch.no_grad():
                 feats = self.backbone(x)
-            feats = feats.squeeze().cpu().numpy().astype('float32')  # 2048
+            feats = feats.flatten().cpu().numpy().astype('float32')  # 2048（ResNet-50）
             norm = np.linalg.norm(feats)
             if norm > 0:
                 feats = feats / norm
@@ -298,6 +237,81 @@ class FeatureExtractor:
                 pass
             return None
 
+    def prepare_views(self, image_path, data=None):
+        """画像全体とタイルを前処理したテンソル (n, 3, 224, 224) と各領域の情報を返す
+
+        デコードは1回だけ行い、同じ画像から全タイルを切り出す。
+        フレームサンプリング時は選んだフレームごとに画像全体（とタイル）を並べるので、
+        1画像の全フレームが1回のバックボーン推論にまとまる。
+        読み込めない画像は (None, None) を返す。
+        """
+        frames = []
+        try:
+            if ENABLE_FRAME_SAMPLING:
+                frames, frame_count = self._load_frames(image_path, data)
+            else:
+                img = self._load_image(image_path, data)
+                frames, frame_count = ([(0, img)] if img is not None else []), 1
+            if not frames:
+                return None, None
+            tensors = []
+            views = []
+            for frame_index, img in frames:
+                if ENABLE_TILED_SEARCH:
+                    boxes = compute_tile_boxes(img.width, img.height)
+                else:
+                    boxes = [(0, 0, img.width, img.height)]
+                # 先頭は従来通りの画像全体（中央切り抜き）
+                tensors.append(self.transform(img))
+                tensors.extend(self.tile_transform(img.crop(box)) for box in boxes[1:])
+                views.extend(
+                    {'box': box, 'image_size': (img.width, img.height), 'frame': frame_index,
+                     'frame_count': frame_count}
+                    for box in boxes
+                )
+            return torch.stack(tensors), views
+        except Exception:
+            return None, None
+        finally:
+            for _, img in frames:
+                img.close()
+
+    def embed_tensors(self, x):
+        """前処理済みテンソルをまとめてバックボーンに通し、L2正規化した特徴ベクトルを返す"""
+        with torch.no_grad():
+            feats = self.backbone(x.to(self.device))
+        feats = feats.flatten(1).cpu().numpy().astype('float32')  # (n, 2048)
+        norms = np.linalg.norm(feats, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return feats / norms
+
+def frame_signature(img, size=(32, 32)):
+    """フレーム比較用の縮小グレースケール画像（0〜1）"""
+    return np.asarray(img.convert("L").resize(size, Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+
+def compute_tile_boxes(width, height):
+    """画像全体 + ピラミッド状の格子タイルの領域 (x0, y0, x1, y1) を粗い段から順に返す"""
+    boxes = [(0, 0, width, height)]
+    for n in TILE_GRID_LEVELS:
+        tile_w = width / n
+        tile_h = height / n
+        if tile_w < MIN_TILE_SIZE or tile_h < MIN_TILE_SIZE:
+            break
+        # 重なりを持たせてタイルの境界にまたがる対象も拾う
+        step_w = tile_w * (1 - TILE_OVERLAP)
+        step_h = tile_h * (1 - TILE_OVERLAP)
+        cols = int(round((width - tile_w) / step_w)) + 1
+        rows = int(round((height - tile_h) / step_h)) + 1
+        # 段の途中で打ち切ると画像の一部しか覆えないので、収まらない段は丸ごと使わない
+        if len(boxes) + rows * cols > MAX_TILES_PER_IMAGE:
+            break
+        for r in range(rows):
+            for c in range(cols):
+                x0 = int(round(min(c * step_w, width - tile_w)))
+                y0 = int(round(min(r * step_h, height - tile_h)))
+                boxes.append((x0, y0, int(round(x0 + tile_w)), int(round(y0 + tile_h))))
+    return boxes
+
 def get_images_from_dir(dir_path):
     image_paths = []
     for ext in IMAGE_EXTENSIONS:
@@ -305,15 +319,18 @@ def get_images_from_dir(dir_path):
         image_paths.extend(glob.glob(os.path.join(dir_path, f"*{ext.upper()}")))
     return sorted(image_paths)
 
-def compute_embeddings_for_list(paths, extractor, show_progress=False):
+def compute_embeddings_for_list(paths, extractor, show_progress=False, sources=None):
+    """特徴ベクトルを計算（sources に (パス, バイト列) を渡すとそれを使ってデコード）"""
+    if sources is None:
+        sources = iter_image_sources(paths, max_member_size=MAX_IMAGE_FILE_SIZE)
     embeddings = []
     valid_paths = []
     error_count = 0
-    for i, p in enumerate(paths):
+    for i, (p, data) in enumerate(sources):
         if show_progress and i % 50 == 0:
             print(f"   Processed {i}/{len(paths)} (errors: {error_count})")
         try:
-            f = extractor.extract(p)
+            f = extractor.extract(p, data=data)
             if f is not None:
                 embeddings.append(f)
                 valid_paths.append(p)
@@ -329,173 +346,526 @@ def compute_embeddings_for_list(paths, extractor, show_progress=False):
     if embeddings:
         return np.vstack(embeddings).astype('float32'), valid_paths
     else:
-        return np.array([], dtype='float32').reshape(0,2048), []
+        return np.array([], dtype='float32').reshape(0, extractor.dim), []
+
+# --------- 検索対象の収集 ----------
+def build_excluded_dirs(search_root):
+    """検索対象ディレクトリから除外ディレクトリの一覧を作成"""
+    search_root_abs = os.path.abspath(search_root)
+    return [
+        os.path.join(search_root_abs, ".nuxt", "dist"),
+        os.path.join(search_root_abs, "node_modules")
+    ]
+
+def collect_search_image_paths(search_root, excluded_dirs, skip_dirs=()):
+    """検索対象画像パスを収集（同名・同階層で拡張子違いは1つだけ）"""
+    search_image_paths = []
+    seen_basenames = {}  # {(dir_path, basename_without_ext): full_path}
+    archive_image_count = 0
+    skip_dirs = {os.path.abspath(d) for d in skip_dirs}
+    for root, _, files in os.walk(search_root):
+        if any(os.path.abspath(root).startswith(excluded) for excluded in excluded_dirs):
+            continue
+        if os.path.abspath(root) in skip_dirs:
+            continue
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                full_path = os.path.join(root, file)
+                basename_without_ext = os.path.splitext(file)[0]
+                key = (root, basename_without_ext)
+
+                # 同じ階層・同じ名前の画像が既にある場合はスキップ
+                if key not in seen_basenames:
+                    seen_basenames[key] = full_path
+                    search_image_paths.append(full_path)
+            elif ENABLE_ARCHIVE_SEARCH and is_archive(file):
+                # アーカイブ内の画像は仮想パス（bundle.zip!/img/logo.png）として追加
+                archive_images = list_archive_images(os.path.join(root, file), IMAGE_EXTENSIONS)
+                search_image_paths.extend(archive_images)
+                archive_image_count += len(archive_images)
+
+    # アーカイブごとに1回のオープンで順次読み出せる順序に並べる
+    return order_for_streaming(search_image_paths), archive_image_count
+
+# --------- Target画像セット ----------
+def resolve_target_sets(script_dir):
+    """TARGET_SETS 設定を [{'name', 'dir', 'tolerance'}, ...] に正規化"""
+    if not TARGET_SETS:
+        return [{
+            'name': DEFAULT_TARGET_SET,
+            'dir': os.path.join(script_dir, "target"),
+            'tolerance': TOLERANCE,
+        }]
+    target_sets = []
+    for name, config in TARGET_SETS.items():
+        target_dir = config['dir']
+        if not os.path.isabs(target_dir):
+            target_dir = os.path.join(script_dir, target_dir)
+        target_sets.append({
+            'name': name,
+            'dir': target_dir,
+            'tolerance': config.get('tolerance', TOLERANCE),
+        })
+    return target_sets
+
+def build_target_set(target_set, extractor):
+    """Target画像セットの埋め込みを計算し、FAISSインデックスを構築（失敗時は None）"""
+    name = target_set['name']
+    target_dir = target_set['dir']
+    if not os.path.exists(target_dir):
+        print(f"❌ [{name}] Target directory not found: {target_dir}")
+        return None
 
-# --------- メイン ----------
-SEARCH_ROOT = sys.argv[1] if len(sys.argv) > 1 else "."
-
-# 除外ディレクトリを動的に構築
-SEARCH_ROOT_ABS = os.path.abspath(SEARCH_ROOT)
-EXCLUDED_DIRS = [
-    os.path.join(SEARCH_ROOT_ABS, ".nuxt", "dist"),
-    os.path.join(SEARCH_ROOT_ABS, "node_modules")
-]
-
-script_dir = os.path.dirname(os.path.abspath(__file__))
-target_dir = os.path.join(script_dir, "target")
-
-print("=" * 60)
-print("🔍 Image Similarity (FAISS accelerated)")
-print("=" * 60)
-print(f"📊 Settings:")
-print(f"   - Similarity threshold: {TOLERANCE}")
-print(f"   - Max Results: {MAX_RESULTS if MAX_RESULTS else 'No limit'}")
-print(f"   - Max Target Images: {MAX_TARGET_IMAGES if MAX_TARGET_IMAGES else 'No limit'}")
-print(f"   - Search Root: {SEARCH_ROOT}")
-print(f"   - Target Directory: {target_dir}")
-print(f"   - Spreadsheet Output: {ENABLE_SPREADSHEET}")
-print(f"   - HTML Report: {ENABLE_HTML_REPORT}")
-print("=" * 60)
-
-if not os.path.exists(target_dir):
-    print(f"❌ Target directory not found: {target_dir}")
-    sys.exit(1)
-
-worksheet = None
-if ENABLE_SPREADSHEET:
-    worksheet = setup_google_sheets()
-
-# ターゲット埋め込み作成とインデックス構築
-target_image_paths = get_images_from_dir(target_dir)
-if not target_image_paths:
-    print("❌ No target images found.")
-    sys.exit(1)
-
-# Target画像数を制限（設定されている場合）
-if MAX_TARGET_IMAGES is not None and len(target_image_paths) > MAX_TARGET_IMAGES:
-    print(f"ℹ️  Limiting target images from {len(target_image_paths)} to {MAX_TARGET_IMAGES}")
-    target_image_paths = target_image_paths[:MAX_TARGET_IMAGES]
-
-extractor = FeatureExtractor()
-print(f"🧠 Extracting target features from {len(target_image_paths)} images...")
-target_embeddings, valid_target_paths = compute_embeddings_for_list(target_image_paths, extractor, show_progress=True)
-if target_embeddings.shape[0] == 0:
-    print("❌ Failed to compute target embeddings.")
-    sys.exit(1)
-
-dim = target_embeddings.shape[1]  # 2048
-# FAISS 内積インデックス（L2 正規化済みベクトルに対して内積がコサイン類似度）
-index = faiss.IndexFlatIP(dim)
-print(f"📚 Adding {target_embeddings.shape[0]} vectors to FAISS index...")
-index.add(target_embeddings)  # ベクトルを追加
-
-# 検索対象画像パスを収集（同名・同階層で拡張子違いは1つだけ）
-search_image_paths = []
-seen_basenames = {}  # {(dir_path, basename_without_ext): full_path}
-for root, _, files in os.walk(SEARCH_ROOT):
-    if any(os.path.abspath(root).startswith(excluded) for excluded in EXCLUDED_DIRS):
-        continue
-    if os.path.abspath(root) == os.path.abspath(target_dir):
-        continue
-    for file in files:
-        if file.lower().endswith(IMAGE_EXTENSIONS):
-            full_path = os.path.join(root, file)
-            basename_without_ext = os.path.splitext(file)[0]
-            key = (root, basename_without_ext)
-
-            # 同じ階層・同じ名前の画像が既にある場合はスキップ
-            if key not in seen_basenames:
-                seen_basenames[key] = full_path
-                search_image_paths.append(full_path)
-
-print(f"🔎 Found {len(search_image_paths)} images to search through.")
-
-results = []
-match_count = 0
-BATCH_READ = 1  # クエリをバッチで処理（メモリ使用量を抑えるため）
-all_similarities = []  # すべての類似度を記録
-
-for i in range(0, len(search_image_paths), BATCH_READ):
-    batch_paths = search_image_paths[i:i+BATCH_READ]
-    batch_num = i//BATCH_READ + 1
-    total_batches = (len(search_image_paths) + BATCH_READ - 1)//BATCH_READ
-
-    # 100画像ごとに進捗表示
-    if batch_num % 100 == 1 or batch_num == 1:
-        print(f"🔍 Processing image {i+1}/{len(search_image_paths)}...")
+    target_image_paths = get_images_from_dir(target_dir)
+    if not target_image_paths:
+        print(f"❌ [{name}] No target images found.")
+        return None
 
-    try:
-        batch_embeddings, valid_batch_paths = compute_embeddings_for_list(batch_paths, extractor)
-    except Exception as batch_error:
-        print(f"   ⚠️  Image {i+1} failed, skipping...")
-        continue
-    if batch_embeddings.shape[0] == 0:
-        continue
-    # FAISS による検索（内積なので高いほど類似）
-    # k = TOP_K（候補数）
-    D, I = index.search(batch_embeddings, TOP_K)  # D: (b, k) similarities, I: (b, k) indices
-    for bi in range(D.shape[0]):
-        if MAX_RESULTS and match_count >= MAX_RESULTS:
-            break
-        sims = D[bi]  # shape (k,)
-        idxs = I[bi]
-        # 最も類似な候補（k=TOP_Kのうちの1つ）が閾値以上なら記録
-        best_k = int(np.argmax(sims))
-        best_sim = float(sims[best_k])
-        best_idx = int(idxs[best_k])
-
-        # すべての類似度を記録
-        all_similarities.append(best_sim)
-        if best_sim >= TOLERANCE:
-            matched_target_path = valid_target_paths[best_idx]
+    # Target画像数を制限（設定されている場合）
+    if MAX_TARGET_IMAGES is not None and len(target_image_paths) > MAX_TARGET_IMAGES:
+        print(f"ℹ️  [{name}] Limiting target images from {len(target_image_paths)} to {MAX_TARGET_IMAGES}")
+        target_image_paths = target_image_paths[:MAX_TARGET_IMAGES]
+
+    print(f"🧠 [{name}] Extracting target features from {len(target_image_paths)} images...")
+    target_embeddings, valid_target_paths = compute_embeddings_for_list(target_image_paths, extractor, show_progress=True)
+    if target_embeddings.shape[0] == 0:
+        print(f"❌ [{name}] Failed to compute target embeddings.")
+        return None
+
+    dim = target_embeddings.shape[1]  # 2048
+    # FAISS 内積インデックス（L2 正規化済みベクトルに対して内積がコサイン類似度）
+    index = faiss.IndexFlatIP(dim)
+    print(f"📚 [{name}] Adding {target_embeddings.shape[0]} vectors to FAISS index...")
+    index.add(target_embeddings)  # ベクトルを追加
+
+    return dict(
+        target_set,
+        index=index,
+        target_paths=valid_target_paths,
+        results=[],
+        similarities=[],  # すべての検索画像の最高類似度
+        similarity_paths=[],  # similarities と同じ順の検索画像パス
+    )
+
+def build_cascade_index(target_set, cascade_extractor):
+    """カスケード検索用に、軽量モデルでTarget画像セットのインデックスを構築"""
+    name = target_set['name']
+    print(f"🧠 [{name}] Extracting cascade ({cascade_extractor.model_name}) target features...")
+    embeddings, _ = compute_embeddings_for_list(target_set['target_paths'], cascade_extractor)
+    if embeddings.shape[0] == 0:
+        print(f"❌ [{name}] Failed to compute cascade target embeddings.")
+        return False
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    target_set['cascade_index'] = index
+    return True
+
+def cascade_filter(target_sets, cascade_embeddings):
+    """軽量モデルの埋め込みで候補を絞り込み、ResNet-50 に通す行のマスクを返す
+
+    どれかのTarget画像セットで CASCADE_TOLERANCE 以上なら通過とする。
+    """
+    passed = np.zeros(cascade_embeddings.shape[0], dtype=bool)
+    for target_set in target_sets:
+        D, _ = target_set['cascade_index'].search(cascade_embeddings, 1)
+        passed |= D[:, 0] >= CASCADE_TOLERANCE
+    return passed
+
+def search_target_sets(target_sets, embeddings, paths, owners=None, views=None, max_results=MAX_RESULTS):
+    """検索画像の埋め込みをまとめて全Target画像セットのインデックスと照合
+
+    コーパス側の埋め込みは1回だけ計算し、セットごとにバッチ検索する。
+    タイル検索・フレームサンプリングでは embeddings の各行が1タイル（1フレーム）で、
+    owners[行] が paths 上の画像番号、views[行] がタイルの領域とフレームの情報になる。
+    画像ごとに最も類似したタイル（フレーム）で判定する。
+    max_results はセットごとのマッチ数の上限（None = 制限なし）。
+    今回新たに見つかったマッチのリストを返す。
+    """
+    new_results = []
+    if owners is None:
+        owners = np.arange(len(paths))
+    owners = np.asarray(owners)
+    for target_set in target_sets:
+        # FAISS による検索（内積なので高いほど類似）
+        # k = TOP_K（候補数）
+        k = min(TOP_K, target_set['index'].ntotal)
+        D, I = target_set['index'].search(embeddings, k)  # D: (n, k) similarities, I: (n, k) indices
+        # 各行で最も類似な候補（k=TOP_Kのうちの1つ）
+        best_k = np.argmax(D, axis=1)
+        row_best_sims = D[np.arange(D.shape[0]), best_k]
+        row_best_idxs = I[np.arange(I.shape[0]), best_k]
+        for bi in range(len(paths)):
+            rows = np.flatnonzero(owners == bi)
+            if rows.size == 0:
+                continue
+            # 画像内で最も類似したタイル・フレーム（どちらも使わなければ1行だけ）
+            best_row = int(rows[np.argmax(row_best_sims[rows])])
+            best_sim = float(row_best_sims[best_row])
+            best_idx = int(row_best_idxs[best_row])
+            view = views[best_row] if views is not None else None
+            # 画像全体以外のタイルでマッチした場合はその領域
+            box = None
+            if view is not None and view['box'] != (0, 0, *view['image_size']):
+                box = view['box']
+            # 複数フレーム画像ならマッチしたフレーム番号
+            frame = None
+            if view is not None and view.get('frame_count', 1) > 1:
+                frame = view['frame']
+
+            # すべての類似度を記録
+            target_set['similarities'].append(best_sim)
+            target_set['similarity_paths'].append(paths[bi])
+            table = target_set.get('table')
+            if table is not None:
+                # 閾値に関係なく上位K件を結果テーブルに保存（再集計用）
+                table.write(
+                    target_set['table_rows'][paths[bi]], D[best_row], I[best_row],
+                    box=box, image_size=view['image_size'] if box else None, frame=frame,
+                )
+            if best_sim < target_set['tolerance']:
+                continue
+            if max_results and len(target_set['results']) >= max_results:
+                continue
+            matched_target_path = target_set['target_paths'][best_idx]
             matched_target_name = os.path.basename(matched_target_path)
-            matched_search_path = valid_batch_paths[bi]
-            match_count += 1
-            print(f"✅ Match {match_count}: {matched_search_path}  <->  {matched_target_name}  (sim={best_sim:.3f})")
-            results.append({
+            matched_search_path = paths[bi]
+            result = {
+                'target_set': target_set['name'],
                 'target_image': matched_target_name,
                 'target_image_path': matched_target_path,
                 'matched_path': matched_search_path,
                 'similarity': f"{best_sim:.3f}"
-            })
-            if MAX_RESULTS and match_count >= MAX_RESULTS:
-                break
-
-print("🏁 Search completed.")
-print(f"📊 Total matches found: {len(results)}")
-
-# 類似度の統計情報を表示
-if all_similarities:
-    all_similarities_arr = np.array(all_similarities)
-    print(f"\n📈 Similarity Statistics:")
-    print(f"   - Max similarity: {np.max(all_similarities_arr):.4f}")
-    print(f"   - Mean similarity: {np.mean(all_similarities_arr):.4f}")
-    print(f"   - Median similarity: {np.median(all_similarities_arr):.4f}")
-    print(f"   - Min similarity: {np.min(all_similarities_arr):.4f}")
-    print(f"   - Threshold: {TOLERANCE}")
-    # 上位10件を表示
-    top_10_idx = np.argsort(all_similarities_arr)[-10:][::-1]
-    print(f"\n🔝 Top 10 similarities:")
-    for idx in top_10_idx:
-        if idx < len(search_image_paths):
-            print(f"   - {all_similarities_arr[idx]:.4f}: {search_image_paths[idx]}")
-
-# 出力
-if results:
-    if ENABLE_HTML_REPORT:
-        report_path = generate_html_report(results)
-        if report_path:
-            print(f"✅ HTML report available: {os.path.abspath(report_path)}")
-    if ENABLE_SPREADSHEET and worksheet:
-        print("\n📝 Writing results to Google Sheets...")
-        success = write_to_sheet_batch(worksheet, results)
-        if success:
-            print(f"🔗 Spreadsheet available: {SPREADSHEET_URL}")
-        else:
-            print("❌ Failed to write to spreadsheet.")
-else:
-    print("ℹ️ No matches found.")
+            }
+            location = ""
+            if frame is not None:
+                result['frame'] = frame
+                location += f" @ frame {frame}"
+            if box is not None:
+                result['box'] = box
+                result['image_size'] = view['image_size']
+                location += f" @ tile {box}"
+            target_set['results'].append(result)
+            new_results.append(result)
+            print(f"✅ [{target_set['name']}] Match {len(target_set['results'])}: {matched_search_path}{location}  <->  {matched_target_name}  (sim={best_sim:.3f})")
+    return new_results
+
+# --------- メイン ----------
+def run_params(target_sets):
+    """実行履歴ストアに記録する検索パラメータ"""
+    return {
+        'tolerance': TOLERANCE,
+        'top_k': TOP_K,
+        'max_results': MAX_RESULTS,
+        'max_target_images': MAX_TARGET_IMAGES,
+        'target_sets': [
+            {'name': t['name'], 'dir': t['dir'], 'tolerance': t['tolerance'], 'images': len(t['target_paths'])}
+            for t in target_sets
+        ],
+        'archive_search': ENABLE_ARCHIVE_SEARCH,
+        'tiled_search': ENABLE_TILED_SEARCH,
+        'frame_sampling': MAX_FRAMES if ENABLE_FRAME_SAMPLING else None,
+        'cascade': CASCADE_MODEL if ENABLE_CASCADE else None,
+    }
+
+def main():
+    search_root = sys.argv[1] if len(sys.argv) > 1 else "."
+    started_at = datetime.now().isoformat(timespec='seconds')
+    # 単体実行時も1回の実行の出力が同じディレクトリに揃うようにタイムスタンプを固定
+    os.environ.setdefault('OUTPUT_TIMESTAMP', datetime.now().strftime('%Y%m%d_%H%M%S'))
+    timings = {}  # 工程ごとの処理時間（秒）
+    stage_start = time.perf_counter()
+
+    # 除外ディレクトリを動的に構築
+    excluded_dirs = build_excluded_dirs(search_root)
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    target_set_configs = resolve_target_sets(script_dir)
+    export_formats = list(EXPORT_FORMATS)
+    if ENABLE_SPREADSHEET and "sheets" not in export_formats:
+        export_formats.append("sheets")
+
+    print("=" * 60)
+    print("🔍 Image Similarity (FAISS accelerated)")
+    print("=" * 60)
+    print(f"📊 Settings:")
+    print(f"   - Similarity threshold: {TOLERANCE}")
+    print(f"   - Max Results: {MAX_RESULTS if MAX_RESULTS else 'No limit'}")
+    print(f"   - Max Target Images: {MAX_TARGET_IMAGES if MAX_TARGET_IMAGES else 'No limit'}")
+    print(f"   - Search Root: {search_root}")
+    for config in target_set_configs:
+        print(f"   - Target Directory [{config['name']}]: {config['dir']} (threshold: {config['tolerance']})")
+    print(f"   - Archive Search: {ENABLE_ARCHIVE_SEARCH}")
+    print(f"   - Tiled Search: {f'levels {TILE_GRID_LEVELS}, up to {MAX_TILES_PER_IMAGE} tiles/image' if ENABLE_TILED_SEARCH else False}")
+    print(f"   - Frame Sampling: {f'up to {MAX_FRAMES} frames/image (change threshold: {FRAME_CHANGE_THRESHOLD})' if ENABLE_FRAME_SAMPLING else False}")
+    print(f"   - Cascade: {f'{CASCADE_MODEL} (threshold: {CASCADE_TOLERANCE})' if ENABLE_CASCADE else False}")
+    print(f"   - Read-ahead: {f'{READ_AHEAD_DEPTH} images / {READ_AHEAD_WORKERS} threads' if ENABLE_READ_AHEAD else False}")
+    print(f"   - Exports: {', '.join(export_formats) if export_formats else 'None'}")
+    print(f"   - HTML Report: {ENABLE_HTML_REPORT}")
+    print("=" * 60)
+
+    # ターゲット埋め込み作成とインデックス構築（セットごと）
+    extractor = FeatureExtractor()
+    target_sets = []
+    for config in target_set_configs:
+        target_set = build_target_set(config, extractor)
+        if target_set is not None:
+            target_sets.append(target_set)
+    if not target_sets:
+        print("❌ No usable target sets.")
+        sys.exit(1)
+    timings['targets'] = time.perf_counter() - stage_start
+
+    # カスケード用の軽量モデルとインデックス
+    cascade_extractor = None
+    # タイル・フレームごとに特徴抽出する（画像ごとに複数行の埋め込みになる）
+    use_views = ENABLE_TILED_SEARCH or ENABLE_FRAME_SAMPLING
+    if ENABLE_CASCADE and use_views:
+        # 軽量モデルは先頭フレームの画像全体しか見ないため、タイルや途中のフレームにだけ写る対象を取りこぼす
+        print("⚠️  Cascade is not supported with tiled search or frame sampling, disabling cascade.")
+    elif ENABLE_CASCADE:
+        cascade_extractor = FeatureExtractor(model_name=CASCADE_MODEL, weights_path=CASCADE_WEIGHTS_PATH)
+        if not all(build_cascade_index(target_set, cascade_extractor) for target_set in target_sets):
+            print("⚠️  Failed to build cascade indexes, disabling cascade.")
+            cascade_extractor = None
+
+    stage_start = time.perf_counter()
+    search_image_paths, archive_image_count = collect_search_image_paths(
+        search_root, excluded_dirs, skip_dirs=[config['dir'] for config in target_set_configs]
+    )
+    timings['discovery'] = time.perf_counter() - stage_start
+    print(f"🔎 Found {len(search_image_paths)} images to search through.")
+    if archive_image_count:
+        print(f"   (including {archive_image_count} images inside archives)")
+
+    BATCH_READ = 1  # クエリをバッチで処理（メモリ使用量を抑えるため）
+    pending_embeddings = []  # 検索待ちの埋め込み（SEARCH_BATCH_SIZE 件ごとにまとめて検索）
+    pending_paths = []
+    pending_owners = []  # 埋め込みの各行が pending_paths の何番目の画像か
+    pending_views = []  # 埋め込みの各行のタイル・フレーム情報（use_views の時のみ）
+    tile_tensors = []  # バックボーン待ちのタイル・フレーム（TILE_BATCH_SIZE 枚ごとにまとめて推論）
+    tile_views = []
+    tile_paths = []
+    cascade_buffer = []  # 軽量モデルで検索待ちの [(パス, バイト列, 埋め込み), ...]
+    cascade_total = 0  # 軽量モデルで検索した画像数
+    cascade_passed = 0  # ResNet-50 に通した画像数
+    # 通常ファイルとアーカイブ内メンバーを (パス, バイト列) で順に読み出す
+    image_sources = iter_image_sources(search_image_paths, max_member_size=MAX_IMAGE_FILE_SIZE)
+    read_stats = ReadStats()
+    if ENABLE_READ_AHEAD:
+        # ファイルの中身を先読みし、デコード・推論と I/O を重ねる
+        image_sources = prefetch_image_sources(
+            image_sources,
+            depth=READ_AHEAD_DEPTH,
+            workers=READ_AHEAD_WORKERS,
+            max_bytes=READ_AHEAD_MAX_BYTES,
+            max_file_size=MAX_IMAGE_FILE_SIZE,
+            stats=read_stats,
+        )
+    # 再集計用の結果テーブル（行番号 = search_image_paths の順）
+    result_table = None
+    if ENABLE_RESULT_TABLE and search_image_paths:
+        result_table = ResultTableWriter(
+            get_output_dir(), search_image_paths, search_root, TOP_K, cascade=cascade_extractor is not None
+        )
+        for target_set in target_sets:
+            target_set['table'] = result_table.add_set(
+                target_set['name'], target_set['dir'], target_set['tolerance'], target_set['target_paths'],
+                k=min(TOP_K, target_set['index'].ntotal),
+            )
+            target_set['table_rows'] = result_table.rows
+
+    # マッチはスキャンと並行してバックグラウンドで書き出す
+    export_queue = None
+    if export_formats:
+        export_queue = ExportQueue(create_exporters(
+            export_formats, get_output_dir(),
+            spreadsheet_id=SPREADSHEET_ID,
+            credentials_path=os.path.join(script_dir, SHEETS_CREDENTIALS_FILE),
+            sheets_api_url=SHEETS_API_URL,
+            sheet_name=SHEETS_SHEET_NAME,
+        ))
+
+    compute_time = 0.0  # デコード・特徴抽出・検索にかかった時間
+    scan_start = time.perf_counter()
+
+    def flush_pending():
+        if pending_embeddings:
+            new_results = search_target_sets(
+                target_sets, np.vstack(pending_embeddings), pending_paths,
+                owners=pending_owners, views=pending_views if use_views else None,
+            )
+            if export_queue is not None:
+                export_queue.put(new_results)
+            pending_embeddings.clear()
+            pending_paths.clear()
+            pending_owners.clear()
+            pending_views.clear()
+
+    def add_pending(embeddings, paths, views_per_path=None):
+        for j, path in enumerate(paths):
+            n_rows = len(views_per_path[j]) if views_per_path else 1
+            pending_owners.extend([len(pending_paths)] * n_rows)
+            pending_paths.append(path)
+            if views_per_path:
+                pending_views.extend(views_per_path[j])
+        pending_embeddings.append(embeddings)
+        if len(pending_paths) >= SEARCH_BATCH_SIZE:
+            flush_pending()
+
+    def flush_cascade():
+        nonlocal cascade_total, cascade_passed
+        if not cascade_buffer:
+            return
+        buffered = list(cascade_buffer)
+        cascade_buffer.clear()
+        passed = cascade_filter(target_sets, np.vstack([feats for _, _, feats in buffered]))
+        candidates = [(path, data) for (path, data, _), ok in zip(buffered, passed) if ok]
+        cascade_total += len(buffered)
+        cascade_passed += len(candidates)
+        if candidates:
+            # 通過した画像だけ ResNet-50 で最終判定
+            embeddings, valid_paths = compute_embeddings_for_list(
+                [path for path, _ in candidates], extractor, sources=candidates
+            )
+            if embeddings.shape[0] > 0:
+                add_pending(embeddings, valid_paths)
+
+    def flush_tiles():
+        if tile_tensors:
+            paths, views = list(tile_paths), list(tile_views)
+            try:
+                # 複数画像のタイル・フレームをまとめて1回でバックボーンに通す
+                embeddings = extractor.embed_tensors(torch.cat(tile_tensors))
+            finally:
+                tile_tensors.clear()
+                tile_views.clear()
+                tile_paths.clear()
+            add_pending(embeddings, paths, views)
+
+    for i in range(0, len(search_image_paths), BATCH_READ):
+        try:
+            batch_sources = list(itertools.islice(image_sources, BATCH_READ))
+        except Exception as e:
+            # 読み込み元は壊れたファイルを None で返すので通常ここには来ないが、
+            # 万一止まってもそれまでの結果でレポート・記録まで行う
+            print(f"   ⚠️  Failed to read images after {i}/{len(search_image_paths)}, stopping scan: {e}")
+            break
+        batch_paths = [p for p, _ in batch_sources]
+        batch_num = i//BATCH_READ + 1
+
+        # 100画像ごとに進捗表示
+        if batch_num % 100 == 1 or batch_num == 1:
+            print(f"🔍 Processing image {i+1}/{len(search_image_paths)}...")
+
+        compute_start = time.perf_counter()
+        try:
+            if use_views:
+                for path, data in batch_sources:
+                    tensors, views = extractor.prepare_views(path, data)
+                    if tensors is None:
+                        continue
+                    tile_tensors.append(tensors)
+                    tile_views.append(views)
+                    tile_paths.append(path)
+                if sum(len(views) for views in tile_views) >= TILE_BATCH_SIZE:
+                    flush_tiles()
+            elif cascade_extractor is not None:
+                for path, data in batch_sources:
+                    feats = cascade_extractor.extract(path, data=data)
+                    if feats is not None:
+                        cascade_buffer.append((path, data, feats))
+                if len(cascade_buffer) >= SEARCH_BATCH_SIZE:
+                    flush_cascade()
+            else:
+                batch_embeddings, valid_batch_paths = compute_embeddings_for_list(batch_paths, extractor, sources=batch_sources)
+                if batch_embeddings.shape[0] > 0:
+                    add_pending(batch_embeddings, valid_batch_paths)
+        except Exception as batch_error:
+            print(f"   ⚠️  Image {i+1} failed, skipping...")
+        compute_time += time.perf_counter() - compute_start
+
+    compute_start = time.perf_counter()
+    try:
+        flush_tiles()
+        flush_cascade()
+    except Exception as batch_error:
+        print(f"   ⚠️  Last batch failed: {batch_error}")
+    flush_pending()
+    compute_time += time.perf_counter() - compute_start
+
+    scan_time = time.perf_counter() - scan_start
+    timings.update(scan=scan_time, io_wait=read_stats.io_wait, compute=compute_time)
+    print("🏁 Search completed.")
+    if result_table is not None:
+        result_table.close()
+        print(f"💾 Result table saved: {result_table.table_dir}")
+    for target_set in target_sets:
+        print(f"📊 Total matches found [{target_set['name']}]: {len(target_set['results'])}")
+
+    # I/O 待ちと計算時間を分けて表示
+    print(f"\n⏱️  Timing:")
+    print(f"   - Scan wall time: {scan_time:.1f}s")
+    if ENABLE_READ_AHEAD:
+        print(f"   - I/O wait: {read_stats.io_wait:.1f}s")
+    else:
+        print(f"   - I/O wait: not measured (read-ahead disabled, included in compute)")
+    print(f"   - Compute (decode + inference + search): {compute_time:.1f}s")
+    if ENABLE_READ_AHEAD and read_stats.files_read:
+        print(f"   - Read-ahead: {read_stats.files_read} files, {read_stats.bytes_read / (1024 * 1024):.1f} MB")
+    if cascade_extractor is not None and cascade_total:
+        print(f"   - Cascade: {cascade_passed}/{cascade_total} images passed to ResNet-50 "
+              f"({100 * cascade_passed / cascade_total:.1f}%)")
+
+    # 類似度の統計情報を表示
+    for target_set in target_sets:
+        print_similarity_statistics(target_set)
+
+    # 出力
+    stage_start = time.perf_counter()
+    all_results = [result for target_set in target_sets for result in target_set['results']]
+    if all_results:
+        if ENABLE_HTML_REPORT:
+            for target_set in target_sets:
+                if not target_set['results']:
+                    continue
+                report_path = generate_html_report(
+                    target_set['results'],
+                    tolerance=target_set['tolerance'],
+                    report_name=report_name_for(target_set, target_sets),
+                    target_set_name=target_set['name'] if len(target_sets) > 1 else None,
+                )
+                if report_path:
+                    print(f"✅ HTML report available: {os.path.abspath(report_path)}")
+    else:
+        print("ℹ️ No matches found.")
+    if export_queue is not None:
+        print("\n📝 Finishing exports...")
+        for name, success in export_queue.close().items():
+            if not success:
+                print(f"❌ Failed to export {name}.")
+            elif name == "sheets":
+                print(f"🔗 Spreadsheet available: {SPREADSHEET_URL}")
+            else:
+                print(f"✅ {name} export: {os.path.join(get_output_dir(), 'matches.' + name)}")
+    timings['output'] = time.perf_counter() - stage_start
+
+    # 実行履歴ストアに記録
+    if ENABLE_RESULTS_STORE:
+        try:
+            conn = results_store.connect(results_store.default_db_path(script_dir))
+            run_id = os.path.basename(get_output_dir())
+            results_store.record_run(
+                conn, run_id, started_at, datetime.now().isoformat(timespec='seconds'), search_root,
+                len(search_image_paths), run_params(target_sets), timings, all_results,
+            )
+            conn.close()
+            print(f"🗄️  Run recorded in results store: {run_id}")
+        except Exception as e:
+            print(f"⚠️  Failed to record run in results store: {e}")
+
+    print("\n" + "=" * 60)
+    print("✅ Process completed!")
+    print("=" * 60)
 
-print("\n" + "=" * 60)
-print("✅ Process completed!")
-print("=" * 60)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+画像の読み込み元（通常ファイル・アーカイブ内メンバー）を扱うモジュール
+
+アーカイブ内の画像は `bundle.zip!/img/logo.png` のような仮想パスで表現し、
+展開せずにメンバーのバイト列から直接デコードする。
+"""
+import io
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# 仮想パスの区切り（アーカイブパスとメンバー名の間）
+ARCHIVE_SEPARATOR = "!/"
+# 中身を検索するアーカイブ形式（npm の tarball は .tgz）
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tgz", ".tar.gz", ".tar.bz2", ".tar.xz")
+
+
+def is_archive(path):
+    """アーカイブとして中身を検索するファイルかどうか"""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def make_virtual_path(archive_path, member_name):
+    """アーカイブパスとメンバー名から仮想パスを作成"""
+    return f"{archive_path}{ARCHIVE_SEPARATOR}{member_name}"
+
+
+def split_virtual_path(path):
+    """仮想パスを (アーカイブパス, メンバー名) に分割（通常ファイルはメンバー名が None）"""
+    if ARCHIVE_SEPARATOR in path:
+        archive_path, member_name = path.split(ARCHIVE_SEPARATOR, 1)
+        if is_archive(archive_path):
+            return archive_path, member_name
+    return path, None
+
+
+def is_virtual_path(path):
+    return split_virtual_path(path)[1] is not None
+
+
+def _is_zip(archive_path):
+    return archive_path.lower().endswith(".zip")
+
+
+def list_archive_images(archive_path, image_extensions):
+    """アーカイブ内の画像メンバーを仮想パスで返す（同名・同階層で拡張子違いは1つだけ）"""
+    image_paths = []
+    seen_basenames = set()  # {(member_dir, basename_without_ext)}
+    try:
+        if _is_zip(archive_path):
+            # ZIP は末尾のセントラルディレクトリだけで一覧を取得できる
+            with zipfile.ZipFile(archive_path) as zf:
+                names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        else:
+            # tar はストリームモードでヘッダーを順に読む（圧縮 tar は一覧のためだけに全体を1回展開する。
+            # 検索時にもう1回展開するので、圧縮 tar は一覧と読み出しで計2回読むことになる）
+            with tarfile.open(archive_path, mode="r|*") as tf:
+                names = [member.name for member in tf if member.isfile()]
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f"⚠️  Failed to read archive {archive_path}: {e}")
+        return []
+
+    for name in names:
+        if not name.lower().endswith(image_extensions):
+            continue
+        member_dir, file = os.path.split(name)
+        key = (member_dir, os.path.splitext(file)[0])
+        if key not in seen_basenames:
+            seen_basenames.add(key)
+            image_paths.append(make_virtual_path(archive_path, name))
+    return image_paths
+
+
+def _iter_archive_members(archive_path, member_names, max_member_size=None):
+    """アーカイブを1回だけ開き、指定メンバーを格納順に (メンバー名, バイト列) で返す
+
+    サイズ上限を超えるメンバーや読み込めないメンバー（壊れた圧縮データなど）はバイト列を None で返す
+    （呼び出し側はアーカイブを開き直さずにスキップすること）。
+    アーカイブが途中で読めなくなっても例外は出さず、残りのメンバーも None で返す。
+    """
+    wanted = set(member_names)
+    try:
+        if _is_zip(archive_path):
+            with zipfile.ZipFile(archive_path) as zf:
+                # ローカルヘッダーのオフセット順に読むとシークが前方向だけになる
+                # 同名のエントリが複数ある zip では、zf.read(名前) と同じく最後のエントリだけを読む
+                present = {info.filename for info in zf.infolist()}
+                infos = sorted(
+                    (zf.getinfo(name) for name in wanted & present),
+                    key=lambda info: info.header_offset,
+                )
+                for info in infos:
+                    wanted.discard(info.filename)
+                    if max_member_size is not None and info.file_size > max_member_size:
+                        yield info.filename, None
+                        continue
+                    try:
+                        data = zf.read(info)
+                    except Exception:
+                        # 壊れたメンバー（zlib.error や CRC 不一致など）は読めなかったものとして扱う
+                        data = None
+                    yield info.filename, data
+        else:
+            # 圧縮 tar でも先頭から順に1回読むだけで済むようストリームモードで開く
+            with tarfile.open(archive_path, mode="r|*") as tf:
+                for member in tf:
+                    if member.name not in wanted:
+                        continue
+                    wanted.discard(member.name)
+                    if max_member_size is not None and member.size > max_member_size:
+                        yield member.name, None
+                        continue
+                    try:
+                        f = tf.extractfile(member)
+                        data = f.read() if f else None
+                    except Exception as e:
+                        # 途中で切れた圧縮 tar などはストリームの続きを読めないので、残りは下でまとめて None にする
+                        print(f"⚠️  Failed to read archive {archive_path}: {e}")
+                        yield member.name, None
+                        break
+                    yield member.name, data
+    except Exception as e:
+        print(f"⚠️  Failed to read archive {archive_path}: {e}")
+
+    # 読めなかったメンバーも呼び出し側で件数を合わせられるように返す
+    for name in member_names:
+        if name in wanted:
+            wanted.discard(name)
+            yield name, None
+
+
+def iter_image_sources(paths, max_member_size=None):
+    """パスのリストを (パス, バイト列) で順に返す
+
+    通常ファイルはバイト列を None で返し（読み込みは呼び出し側で行う）、
+    アーカイブ内メンバーはアーカイブごとにまとめて1回のオープンで順次読み出す。
+    返す順序は通常ファイル → アーカイブごとのメンバーの順になる。
+    """
+    members_by_archive = {}  # {archive_path: [member_name, ...]}（出現順を保持）
+    for path in paths:
+        archive_path, member_name = split_virtual_path(path)
+        if member_name is None:
+            yield path, None
+        else:
+            members_by_archive.setdefault(archive_path, []).append(member_name)
+
+    for archive_path, member_names in members_by_archive.items():
+        for member_name, data in _iter_archive_members(archive_path, member_names, max_member_size):
+            yield make_virtual_path(archive_path, member_name), data
+
+
+def order_for_streaming(paths):
+    """iter_image_sources が返すのと同じ順序にパスを並べ替える"""
+    plain_paths = []
+    members_by_archive = {}
+    for path in paths:
+        archive_path, member_name = split_virtual_path(path)
+        if member_name is None:
+            plain_paths.append(path)
+        else:
+            members_by_archive.setdefault(archive_path, []).append(path)
+    ordered = list(plain_paths)
+    for member_paths in members_by_archive.values():
+        ordered.extend(member_paths)
+    return ordered
+
+
+def read_image_bytes(path):
+    """仮想パスを含む任意のパスから画像のバイト列を読み込む（単発の読み込み用）"""
+    archive_path, member_name = split_virtual_path(path)
+    if member_name is None:
+        with open(path, "rb") as f:
+            return f.read()
+    if _is_zip(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            return zf.read(member_name)
+    with tarfile.open(archive_path, mode="r:*") as tf:
+        f = tf.extractfile(member_name)
+        if f is None:
+            raise FileNotFoundError(path)
+        return f.read()
+
+
+def open_image_source(path):
+    """PIL の Image.open に渡せるオブジェクトを返す（通常ファイルはパスのまま）"""
+    if is_virtual_path(path):
+        return io.BytesIO(read_image_bytes(path))
+    return path
+
+
+def get_source_size(path):
+    """仮想パスを含む任意のパスのバイトサイズ"""
+    archive_path, member_name = split_virtual_path(path)
+    if member_name is None:
+        return os.path.getsize(path)
+    if _is_zip(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            return zf.getinfo(member_name).file_size
+    with tarfile.open(archive_path, mode="r:*") as tf:
+        return tf.getmember(member_name).size
+
+
+class ReadStats:
+    """先読みの計測値（I/O待ち時間と読み込み量）"""
+
+    def __init__(self):
+        self.io_wait = 0.0  # 消費側がバッファの到着を待った時間（秒）
+        self.bytes_read = 0  # スレッドプールで読み込んだ通常ファイルのみ（アーカイブ内メンバーは含まない）
+        self.files_read = 0
+
+
+def _read_file(path, max_size):
+    """ファイルを丸ごと読み込む（上限超過・読み込み失敗時は None）"""
+    try:
+        with open(path, "rb") as f:
+            if max_size is not None and os.fstat(f.fileno()).st_size > max_size:
+                return None
+            # bytes のまま渡せば io.BytesIO はコピーせずにバッファを共有する
+            return f.read()
+    except Exception:
+        return None
+
+
+def _done_future(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _source_size(path, data, max_file_size):
+    """先読みで確保するバイト数（上限超過で読まないファイルは 0、stat に失敗したら 0）"""
+    if data is not None:
+        return len(data)
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return 0
+    return 0 if max_file_size is not None and size > max_file_size else size
+
+
+def prefetch_image_sources(sources, depth, workers, max_bytes, max_file_size=None, stats=None):
+    """(パス, バイト列) の列を受け取り、通常ファイルの中身をスレッドで先読みして順に返す
+
+    NFS/SMB やクラウド同期ディスクのように1回の読み込みが遅いストレージでも、
+    次の depth 件を並行して読んでおくことでデコード・推論と I/O を重ねる。
+    各ファイルのサイズは読み込みを始める時点で確保し、返した時点で解放するので、
+    読み込み中のものも含めた合計が max_bytes を超える読み込みは始めない
+    （ただし1件も先読みしていない時は、max_bytes より大きいファイルでも読む）。
+    アーカイブ内メンバーは元の順序のまま（すでにバイト列を持っているので）そのまま流す。
+    読み込みに失敗したファイルはバイト列を None で返す。
+    """
+    stats = stats if stats is not None else ReadStats()
+    it = iter(sources)
+    window = deque()  # [(path, future, 確保したバイト数, プールで読み込んだか), ...]
+    reserved = 0  # window 内で確保済みのバイト数
+    held = None  # 取り出したが予算に収まらず、まだ読み込みを始めていない (path, data, size)
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while True:
+            while len(window) < depth:
+                if held is None:
+                    if exhausted:
+                        break
+                    # アーカイブ内メンバーはここで順次読み出されるので、その時間も I/O 待ちに含める
+                    wait_start = time.perf_counter()
+                    try:
+                        path, data = next(it)
+                        held = (path, data, _source_size(path, data, max_file_size))
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    finally:
+                        stats.io_wait += time.perf_counter() - wait_start
+                path, data, size = held
+                if window and reserved + size > max_bytes:
+                    break
+                held = None
+                from_pool = data is None
+                if from_pool:
+                    future = pool.submit(_read_file, path, max_file_size)
+                else:
+                    future = _done_future(data)
+                reserved += size
+                window.append((path, future, size, from_pool))
+            if not window:
+                break
+
+            path, future, size, from_pool = window.popleft()
+            wait_start = time.perf_counter()
+            data = future.result()
+            stats.io_wait += time.perf_counter() - wait_start
+            reserved -= size
+            if from_pool and data is not None:
+                stats.bytes_read += len(data)
+                stats.files_read += 1
+            yield path, data
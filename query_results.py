@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+実行履歴ストア（output/results.sqlite3）を問い合わせるスクリプト
+
+使用方法:
+    python query_results.py runs [--limit N]
+    python query_results.py diff [実行A] [実行B] [--set セット名] [--persistent]
+    python query_results.py diff --since 2025-11-10 [実行B] [--set セット名] [--persistent]
+    python query_results.py history <検索画像のパス>
+
+実行は タイムスタンプ / latest / previous で指定する（diff の省略時は previous → latest）。
+"""
+import argparse
+import json
+import os
+import sys
+
+import results_store
+
+def print_runs(conn, args):
+    runs = results_store.list_runs(conn, limit=args.limit)
+    if not runs:
+        print("ℹ️ 記録された実行がありません")
+        return
+    print(f"{'run_id':<17} {'started_at':<20} {'images':>8} {'matches':>8}  search_root")
+    for run in runs:
+        print(f"{run['run_id']:<17} {run['started_at']:<20} {run['image_count'] or 0:>8} "
+              f"{run['match_count']:>8}  {run['search_root']}")
+        if args.verbose:
+            print(f"    params:  {run['params']}")
+            print(f"    timings: {run['timings']}")
+
+def print_diff(conn, args):
+    if args.since:
+        if args.run_a and args.run_b:
+            print("❌ --since と比較元の実行は同時に指定できません（比較先の実行だけ指定してください）")
+            sys.exit(1)
+        # --since のときの位置引数は1つだけで、それが比較先になる
+        run_a = results_store.last_run_before(conn, args.since)
+        run_b = results_store.resolve_run(conn, args.run_b or args.run_a or "latest")
+    else:
+        run_a = results_store.resolve_run(conn, args.run_a or "previous")
+        run_b = results_store.resolve_run(conn, args.run_b or "latest")
+    if not run_a or not run_b:
+        print("❌ 比較する実行が見つかりません")
+        sys.exit(1)
+
+    diff = results_store.diff_runs(conn, run_a, run_b, target_set=args.set_name)
+    print(f"🔀 {run_a} → {run_b}" + (f" [{args.set_name}]" if args.set_name else ""))
+    print(f"   - New: {len(diff['new'])}")
+    print(f"   - Resolved: {len(diff['resolved'])}")
+    print(f"   - Persistent: {len(diff['persistent'])}")
+
+    sections = [("🆕 New", diff['new']), ("✅ Resolved", diff['resolved'])]
+    if args.persistent:
+        sections.append(("🔁 Persistent", diff['persistent']))
+    for title, rows in sections:
+        if not rows:
+            continue
+        print(f"\n{title}:")
+        for row in rows:
+            print(f"   [{row['target_set']}] {row['corpus_path']}  <->  {os.path.basename(row['target_path'])}")
+
+def print_history(conn, args):
+    rows = results_store.match_history(conn, args.path)
+    if not rows:
+        print(f"ℹ️ マッチの記録がありません: {args.path}")
+        return
+    first = rows[0]
+    print(f"📅 First match: {first['started_at']} (run {first['run_id']})")
+    for row in rows:
+        location = f" @ frame {row['frame']}" if row['frame'] is not None else ""
+        location += f" @ tile {tuple(json.loads(row['box']))}" if row['box'] else ""
+        print(f"   {row['run_id']}  [{row['target_set']}] {row['corpus_path']}{location}  <->  "
+              f"{os.path.basename(row['target_path'])}  (sim={row['similarity']:.3f})")
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="実行履歴ストアを問い合わせます")
+    parser.add_argument("--db", default=results_store.default_db_path(script_dir), help="ストアのパス")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    runs_parser = subparsers.add_parser("runs", help="実行の一覧")
+    runs_parser.add_argument("--limit", type=int, default=20)
+    runs_parser.add_argument("-v", "--verbose", action="store_true", help="パラメータと処理時間も表示")
+    runs_parser.set_defaults(func=print_runs)
+
+    diff_parser = subparsers.add_parser("diff", help="2つの実行間で新規・解消・継続しているマッチ")
+    diff_parser.add_argument("run_a", nargs="?", help="比較元（省略時は previous）")
+    diff_parser.add_argument("run_b", nargs="?", help="比較先（省略時は latest）")
+    diff_parser.add_argument("--since", help="この日時より前の最後の実行を比較元にする（例: 2025-11-10）")
+    diff_parser.add_argument("--set", dest="set_name", help="Target画像セットで絞り込む")
+    diff_parser.add_argument("--persistent", action="store_true", help="継続しているマッチも一覧表示")
+    diff_parser.set_defaults(func=print_diff)
+
+    history_parser = subparsers.add_parser("history", help="検索画像のマッチ履歴（最初にマッチした日時）")
+    history_parser.add_argument("path", help="検索画像のパス（完全一致がなければ末尾一致）")
+    history_parser.set_defaults(func=print_history)
+
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        print(f"❌ 実行履歴ストアが見つかりません: {args.db}")
+        sys.exit(1)
+    conn = results_store.connect(args.db)
+    try:
+        args.func(conn, args)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+検索結果のレポート出力（HTMLレポート・類似度の統計表示）
+
+torch / faiss に依存しないので、rethreshold_results.py のようにモデルを使わない
+スクリプトからもすぐに読み込める。
+"""
+import base64
+import io
+import os
+import webbrowser
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from image_sources import open_image_source
+
+DEFAULT_TARGET_SET = "target"
+
+def image_to_base64(image_path, max_size=(150, 112), frame=None):
+    """画像をサムネイル化してBase64エンコード（frame を指定すると複数フレーム画像のそのフレーム）"""
+    try:
+        img = Image.open(open_image_source(image_path))
+        if frame:
+            img.seek(frame)
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        buffered = io.BytesIO()
+        # RGBに変換（PNGやGIFの透過対応）
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            rgb_img.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+            img = rgb_img
+        img.save(buffered, format="JPEG", quality=75)
+        img_str = base64.b64encode(buffered.getvalue()).decode()
+        return f"data:image/jpeg;base64,{img_str}"
+    except Exception as e:
+        print(f"⚠️  Failed to encode {image_path}: {e}")
+        return ""
+
+def get_output_dir():
+    """実行日時ごとのoutputディレクトリ（なければ作成）"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    # 環境変数からタイムスタンプを取得（run_search.shから渡される）
+    timestamp = os.environ.get('OUTPUT_TIMESTAMP', datetime.now().strftime('%Y%m%d_%H%M%S'))
+    output_dir = os.path.join(script_dir, "output", timestamp)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+def generate_html_report(results, tolerance, report_name="image_similarity_faiss_report.html",
+                         target_set_name=None, output_dir=None):
+    print("📄 Generating HTML report with embedded images...")
+    target_set_line = f"<p>Target Set: {target_set_name}</p>" if target_set_name else ""
+    html_content = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Image Similarity Results (FAISS)</title>
+        <meta charset="UTF-8">
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 20px; background-color: #f5f5f5; }}
+            .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 10px; margin-bottom: 30px; }}
+            .summary {{ background: white; padding: 15px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); margin-bottom: 20px; }}
+            .result {{ background: white; margin: 20px 0; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
+            .images {{ display: flex; gap: 30px; align-items: flex-start; flex-wrap: wrap; }}
+            .image-container {{ text-align: center; flex: 1; min-width: 250px; }}
+            .image-container img {{ max-width: 200px; max-height: 200px; }}
+            .thumb {{ position: relative; display: inline-block; line-height: 0; }}
+            .tile-box {{ position: absolute; border: 2px solid #e53935; box-sizing: border-box; }}
+            .tile-info {{ font-size: 12px; color: #e53935; margin-top: 5px; }}
+            .image-path {{ font-size: 12px; color: #666; word-break: break-all; margin-top: 5px; background: #f8f9fa; padding: 5px; border-radius: 4px; }}
+            .distance {{ font-size: 20px; font-weight: bold; margin: 10px 0; padding: 10px; border-radius: 5px; text-align: center; background: #2196F3; color: white; }}
+        </style>
+    </head>
+    <body>
+        <div class="header">
+            <h1>🔍 Image Similarity Results (FAISS)</h1>
+            <p>Generated on: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
+        </div>
+
+        <div class="summary">
+            <h2>📊 Summary</h2>
+            {target_set_line}
+            <p>Total Matches: {len(results)}</p>
+            <p>Tolerance (similarity threshold): {tolerance}</p>
+        </div>
+    """
+    # パスを簡略化する関数
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    def simplify_path(path):
+        """絶対パスを /target/... や /検索dir/... の形式に簡略化"""
+        abs_path = os.path.abspath(path)
+        # targetディレクトリの場合
+        if '/target/' in abs_path:
+            return '/target/' + abs_path.split('/target/')[-1]
+        # 検索対象ディレクトリの場合（プロジェクトルートの親ディレクトリ内）
+        parent_dir = os.path.dirname(script_dir)
+        if parent_dir in abs_path and script_dir not in abs_path:
+            # 親ディレクトリからの相対パスを取得
+            rel_path = os.path.relpath(abs_path, parent_dir)
+            return '/' + rel_path
+        # その他の場合はファイル名のみ
+        return os.path.basename(abs_path)
+
+    for i, result in enumerate(results, 1):
+        sim = float(result['similarity'])
+        # 画像をBase64エンコード
+        target_base64 = image_to_base64(result['target_image_path'])
+        matched_base64 = image_to_base64(result['matched_path'], frame=result.get('frame'))
+
+        # パス表示を簡略化
+        target_display_path = simplify_path(result['target_image_path'])
+        matched_display_path = simplify_path(result['matched_path'])
+
+        # タイル検索でマッチした場合は該当領域を枠で表示
+        tile_box_html = ""
+        tile_info_html = ""
+        if result.get('box'):
+            x0, y0, x1, y1 = result['box']
+            width, height = result['image_size']
+            tile_box_html = (
+                f'<div class="tile-box" style="left:{100 * x0 / width:.2f}%; top:{100 * y0 / height:.2f}%; '
+                f'width:{100 * (x1 - x0) / width:.2f}%; height:{100 * (y1 - y0) / height:.2f}%;"></div>'
+            )
+            tile_info_html = f'<div class="tile-info">Tile: ({x0}, {y0}) - ({x1}, {y1}) / {width}x{height}</div>'
+        # 複数フレーム画像の途中のフレームでマッチした場合はそのフレームを表示
+        if result.get('frame') is not None:
+            tile_info_html += f'<div class="tile-info">Frame: {result["frame"]}</div>'
+
+        html_content += f"""
+        <div class="result">
+            <h3>Match #{i} - Similarity: {sim:.3f}</h3>
+            <div class="images">
+                <div class="image-container">
+                    <h4>Target</h4>
+                    <img src="{target_base64}" alt="Target Image">
+                    <div class="image-path">{target_display_path}</div>
+                </div>
+                <div class="image-container">
+                    <h4>Matched</h4>
+                    <div class="thumb"><img src="{matched_base64}" alt="Matched Image">{tile_box_html}</div>
+                    <div class="image-path">{matched_display_path}</div>
+                    {tile_info_html}
+                </div>
+            </div>
+        </div>
+        """
+    html_content += """
+        <div style="text-align:center; margin:40px 0; padding:20px; background:white; border-radius:10px;">
+            <h3>🎉 Report Generated Successfully!</h3>
+            <p>このHTMLファイルは画像を埋め込んでいるため、単体で共有可能です。</p>
+        </div>
+    </body>
+    </html>
+    """
+    # 実行日時ごとのoutputディレクトリを作成
+    output_dir = output_dir or get_output_dir()
+
+    report_path = os.path.join(output_dir, report_name)
+    try:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write(html_content)
+        try:
+            file_url = f"file://{os.path.abspath(report_path)}"
+            webbrowser.open(file_url)
+        except Exception:
+            pass
+        print(f"✅ HTML report generated: {report_path}")
+        return report_path
+    except Exception as e:
+        print(f"❌ Error generating HTML report: {e}")
+        return None
+
+def print_similarity_statistics(target_set):
+    """Target画像セットごとの類似度の統計情報を表示"""
+    if len(target_set['similarities']) == 0:
+        return
+    all_similarities_arr = np.array(target_set['similarities'])
+    print(f"\n📈 Similarity Statistics [{target_set['name']}]:")
+    print(f"   - Max similarity: {np.max(all_similarities_arr):.4f}")
+    print(f"   - Mean similarity: {np.mean(all_similarities_arr):.4f}")
+    print(f"   - Median similarity: {np.median(all_similarities_arr):.4f}")
+    print(f"   - Min similarity: {np.min(all_similarities_arr):.4f}")
+    print(f"   - Threshold: {target_set['tolerance']}")
+    # 上位10件を表示
+    top_10_idx = np.argsort(all_similarities_arr)[-10:][::-1]
+    print(f"\n🔝 Top 10 similarities:")
+    for idx in top_10_idx:
+        print(f"   - {all_similarities_arr[idx]:.4f}: {target_set['similarity_paths'][idx]}")
+
+def report_name_for(target_set, target_sets):
+    """HTMLレポートのファイル名（Target画像セットが1つだけなら従来の名前）"""
+    if len(target_sets) == 1 and target_set['name'] == DEFAULT_TARGET_SET:
+        return "image_similarity_faiss_report.html"
+    return f"image_similarity_faiss_report_{target_set['name']}.html"
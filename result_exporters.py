@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+検索結果の出力先（CSV / JSONL / Parquet / Google Sheets）
+
+スキャン中に見つかったマッチをキュー経由でバックグラウンドスレッドに渡し、
+スキャンと並行して各出力先に書き出す。
+
+Google Sheets は Sheets API v4 の REST エンドポイントを直接呼び出す。
+base_url を差し替えればローカルのスタブサーバーに対して動作確認できる。
+"""
+import csv
+import email.utils
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+import urllib.error
+import urllib.parse
+import urllib.request
+
+EXPORT_FIELDS = ["target_set", "target_image", "target_image_path", "matched_path", "similarity", "box", "frame"]
+SHEET_HEADERS = ["対象画像", "マッチした画像パス", "Similarity"]
+SHEETS_API_URL = "https://sheets.googleapis.com/v4"
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+
+def result_to_record(result):
+    """結果の dict を出力用のレコードに変換"""
+    record = {field: result.get(field) for field in EXPORT_FIELDS}
+    record['similarity'] = float(result['similarity'])
+    record['box'] = list(result['box']) if result.get('box') else None
+    return record
+
+
+class CsvExporter:
+    name = "csv"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def open(self):
+        self.file = open(self.path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=EXPORT_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, results):
+        for result in results:
+            record = result_to_record(result)
+            record['box'] = json.dumps(record['box']) if record['box'] else ""
+            self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class JsonlExporter:
+    name = "jsonl"
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'w', encoding='utf-8')
+
+    def write(self, results):
+        for result in results:
+            self.file.write(json.dumps(result_to_record(result), ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class ParquetExporter:
+    """Parquet 出力（pyarrow が必要。row_group_size 件ごとに行グループとして書き出す）"""
+    name = "parquet"
+
+    def __init__(self, path, row_group_size=10000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.writer = None
+        self.pa = None
+        self.pq = None
+
+    def open(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("pyarrow is not installed (pip install pyarrow)")
+        self.pa, self.pq = pa, pq
+        self.schema = pa.schema([
+            ("target_set", pa.string()),
+            ("target_image", pa.string()),
+            ("target_image_path", pa.string()),
+            ("matched_path", pa.string()),
+            ("similarity", pa.float32()),
+            ("box", pa.list_(pa.int32())),
+            ("frame", pa.int32()),
+        ])
+        self.writer = pq.ParquetWriter(self.path, self.schema)
+
+    def write(self, results):
+        self.rows.extend(result_to_record(result) for result in results)
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        if self.writer:
+            self._flush()
+            self.writer.close()
+
+
+class AdaptiveRateLimiter:
+    """リクエスト間隔を調整するレート制限
+
+    制限（429）を受けると間隔を倍にし、成功が続くと最小間隔まで徐々に縮める。
+    """
+
+    def __init__(self, min_interval=0.0, max_interval=60.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.next_time = 0.0
+
+    def wait(self):
+        delay = self.next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = time.monotonic() + self.interval
+
+    def on_success(self):
+        self.interval = max(self.min_interval, self.interval * 0.5)
+
+    def on_throttle(self, retry_after=None):
+        self.interval = min(self.max_interval, max(self.interval * 2, self.min_interval, 1.0))
+        if retry_after:
+            self.interval = min(self.max_interval, max(self.interval, retry_after))
+        self.next_time = time.monotonic() + self.interval
+
+
+def parse_retry_after(value):
+    """Retry-After ヘッダー（秒数または HTTP-date）を秒数に変換（解釈できなければ None）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class SheetsExporter:
+    """Google Sheets 出力（Sheets API v4）
+
+    行はバッファしておき、max_rows_per_request 件ごと、および終了時にまとめて
+    1回の values.update で範囲全体を書き込む。429 / 5xx は指数バックオフで再試行する。
+    sheet_name を省略するとスプレッドシートの最初のシートに書き込む（名前はロケールで異なる）。
+    書き込みに一度失敗したら、それ以降は close() でも残りの行を書き込まない。
+    """
+    name = "sheets"
+
+    def __init__(self, spreadsheet_id, sheet_name=None, credentials_path=None, base_url=SHEETS_API_URL,
+                 max_rows_per_request=5000, max_retries=5, backoff_base=1.0, min_interval=0.0, timeout=30):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.credentials_path = credentials_path
+        self.base_url = base_url.rstrip("/")
+        self.max_rows_per_request = max_rows_per_request
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.rate_limiter = AdaptiveRateLimiter(min_interval=min_interval)
+        self.credentials = None
+        self.rows = []
+        self.next_row = 2  # 1行目はヘッダー
+        self.failed = False
+
+    def open(self):
+        if self.credentials_path:
+            self.credentials = self._load_credentials(self.credentials_path)
+        if self.sheet_name is None:
+            self.sheet_name = self._first_sheet_title()
+        self._request("POST", f"/values/{self._quote_range(self._a1_sheet_name())}:clear", {})
+        self._update_range(1, [SHEET_HEADERS])
+
+    def _first_sheet_title(self):
+        """最初のシートの名前（日本語ロケールでは「シート1」など）"""
+        response = self._request("GET", "?fields=sheets.properties")
+        sheets = sorted(response.get("sheets", []), key=lambda sheet: sheet["properties"].get("index", 0))
+        if not sheets:
+            raise RuntimeError(f"Spreadsheet has no sheets: {self.spreadsheet_id}")
+        return sheets[0]["properties"]["title"]
+
+    @staticmethod
+    def _load_credentials(credentials_path):
+        try:
+            from google.oauth2.service_account import Credentials
+        except ImportError:
+            raise RuntimeError('google-auth is not installed (pip install "google-auth[requests]")')
+        return Credentials.from_service_account_file(credentials_path, scopes=SHEETS_SCOPES)
+
+    def _auth_header(self):
+        if self.credentials is None:
+            return {}
+        if not self.credentials.valid:
+            try:
+                # トークンの更新には requests が必要（google-auth[requests] でまとめて入る）
+                from google.auth.transport.requests import Request
+            except ImportError:
+                raise RuntimeError('requests is not installed (pip install "google-auth[requests]")')
+            self.credentials.refresh(Request())
+        return {"Authorization": f"Bearer {self.credentials.token}"}
+
+    def _a1_sheet_name(self):
+        """A1 表記用のシート名（空白や記号を含む名前も通るよう ' で囲み、中の ' は2つ重ねる）"""
+        return "'" + self.sheet_name.replace("'", "''") + "'"
+
+    def _quote_range(self, range_name):
+        return urllib.parse.quote(range_name, safe="")
+
+    def _request(self, method, path, body=None):
+        url = f"{self.base_url}/spreadsheets/{self.spreadsheet_id}{path}"
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            request = urllib.request.Request(url, data=data, method=method, headers={
+                "Content-Type": "application/json", **self._auth_header()})
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    self.rate_limiter.on_success()
+                    return json.loads(response.read() or b"{}")
+            except urllib.error.HTTPError as e:
+                retryable = e.code == 429 or e.code >= 500
+                if not retryable or attempt == self.max_retries:
+                    raise
+                if e.code == 429:
+                    self.rate_limiter.on_throttle(
+                        parse_retry_after(e.headers.get("Retry-After") if e.headers else None))
+            except OSError:
+                # URLError（接続失敗）やタイムアウト
+                if attempt == self.max_retries:
+                    raise
+            # 指数バックオフ（ジッター付き）
+            time.sleep(self.backoff_base * (2 ** attempt) * (0.5 + random.random() / 2))
+
+    def _update_range(self, start_row, values):
+        end_row = start_row + len(values) - 1
+        range_name = f"{self._a1_sheet_name()}!A{start_row}:C{end_row}"
+        self._request(
+            "PUT",
+            f"/values/{self._quote_range(range_name)}?valueInputOption=RAW",
+            {"range": range_name, "majorDimension": "ROWS", "values": values},
+        )
+
+    def write(self, results):
+        self.rows.extend(
+            [result['target_image'], result['matched_path'], result['similarity']] for result in results)
+        if len(self.rows) >= self.max_rows_per_request:
+            self._flush()
+
+    def _flush(self):
+        try:
+            while self.rows:
+                chunk = self.rows[:self.max_rows_per_request]
+                self._update_range(self.next_row, chunk)
+                self.next_row += len(chunk)
+                self.rows = self.rows[len(chunk):]
+        except Exception:
+            # 失敗後に残りの行だけ書き込まれて、成功したように見えるシートにならないようにする
+            self.failed = True
+            self.rows = []
+            raise
+
+    def close(self):
+        if not self.failed:
+            self._flush()
+
+
+def create_exporters(formats, output_dir, spreadsheet_id=None, credentials_path=None,
+                     sheets_api_url=SHEETS_API_URL, sheet_name=None):
+    """出力形式の一覧から出力先を作成"""
+    exporters = []
+    for fmt in formats:
+        if fmt == "csv":
+            exporters.append(CsvExporter(os.path.join(output_dir, "matches.csv")))
+        elif fmt == "jsonl":
+            exporters.append(JsonlExporter(os.path.join(output_dir, "matches.jsonl")))
+        elif fmt == "parquet":
+            exporters.append(ParquetExporter(os.path.join(output_dir, "matches.parquet")))
+        elif fmt == "sheets":
+            exporters.append(SheetsExporter(
+                spreadsheet_id, sheet_name=sheet_name, credentials_path=credentials_path,
+                base_url=sheets_api_url))
+        else:
+            raise ValueError(f"Unknown export format: {fmt}")
+    return exporters
+
+
+class ExportQueue:
+    """マッチをキュー経由でバックグラウンドスレッドから各出力先に書き出す
+
+    1つの出力先が失敗しても他の出力先とスキャンは止めない。
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, exporters):
+        self.exporters = []
+        for exporter in exporters:
+            try:
+                exporter.open()
+                self.exporters.append(exporter)
+            except Exception as e:
+                print(f"❌ Failed to open {exporter.name} export: {e}")
+        self.queue = queue.Queue()
+        self.errors = {}
+        self.thread = threading.Thread(target=self._run, name="result-export", daemon=True)
+        self.thread.start()
+
+    def put(self, results):
+        if results and self.exporters:
+            self.queue.put(list(results))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._CLOSE:
+                break
+            # 溜まっている分はまとめて書き出す
+            batch = list(item)
+            while True:
+                try:
+                    more = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is self._CLOSE:
+                    self.queue.put(more)
+                    break
+                batch.extend(more)
+            self._write(batch)
+
+    def _write(self, results):
+        for exporter in self.exporters:
+            if exporter.name in self.errors:
+                continue
+            try:
+                exporter.write(results)
+            except Exception as e:
+                self.errors[exporter.name] = e
+                print(f"❌ Error writing {exporter.name} export: {e}")
+
+    def close(self):
+        """キューを書き出し終えてから全出力先を閉じる"""
+        self.queue.put(self._CLOSE)
+        self.thread.join()
+        for exporter in self.exporters:
+            try:
+                exporter.close()
+            except Exception as e:
+                self.errors.setdefault(exporter.name, e)
+                print(f"❌ Error closing {exporter.name} export: {e}")
+        return {exporter.name: exporter.name not in self.errors for exporter in self.exporters}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+検索結果テーブル（検索画像ごとの上位K件のTarget画像と類似度）の保存・読み込み
+
+スキャン時に全検索画像の上位K件をメモリマップ配列として output/<ts>/result_table/ に保存し、
+閾値や件数を変えた再集計・HTMLレポートの再生成を再スキャンなしで行えるようにする。
+
+    result_table/
+    ├── meta.json             # 検索パラメータとTarget画像セットの一覧
+    ├── corpus_paths.json     # 行番号 → 検索画像パス
+    └── <セット名>/
+        ├── target_paths.json # Target画像ID → パス
+        ├── ids.npy           # (N, K) int32  Target画像ID（-1 = 未検索・失敗）
+        ├── scores.npy        # (N, K) float32 類似度（降順）
+        ├── boxes.npy         # (N, 4) int32  マッチしたタイルの領域（-1 = 画像全体）
+        ├── image_sizes.npy   # (N, 2) int32  画像サイズ（タイル検索時のみ）
+        └── frames.npy        # (N,)   int32  マッチしたフレーム番号（-1 = 単一フレームの画像）
+"""
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+TABLE_DIR_NAME = "result_table"
+
+
+def _write_json(path, obj):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def _read_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class ResultTableSetWriter:
+    """Target画像セット1つ分の上位K件テーブル"""
+
+    def __init__(self, set_dir, n_rows, k, target_paths):
+        os.makedirs(set_dir, exist_ok=True)
+        _write_json(os.path.join(set_dir, "target_paths.json"), list(target_paths))
+        self.k = k
+        self.ids = np.lib.format.open_memmap(
+            os.path.join(set_dir, "ids.npy"), mode='w+', dtype=np.int32, shape=(n_rows, k))
+        self.scores = np.lib.format.open_memmap(
+            os.path.join(set_dir, "scores.npy"), mode='w+', dtype=np.float32, shape=(n_rows, k))
+        self.boxes = np.lib.format.open_memmap(
+            os.path.join(set_dir, "boxes.npy"), mode='w+', dtype=np.int32, shape=(n_rows, 4))
+        self.image_sizes = np.lib.format.open_memmap(
+            os.path.join(set_dir, "image_sizes.npy"), mode='w+', dtype=np.int32, shape=(n_rows, 2))
+        self.frames = np.lib.format.open_memmap(
+            os.path.join(set_dir, "frames.npy"), mode='w+', dtype=np.int32, shape=(n_rows,))
+        self.ids[:] = -1
+        self.scores[:] = -1.0
+        self.boxes[:] = -1
+        self.image_sizes[:] = -1
+        self.frames[:] = -1
+
+    def write(self, row, sims, idxs, box=None, image_size=None, frame=None):
+        """1画像分の上位K件を書き込む（類似度の降順に並べ替える）"""
+        order = np.argsort(-sims)[:self.k]
+        n = len(order)
+        self.ids[row, :n] = idxs[order]
+        self.scores[row, :n] = sims[order]
+        if box is not None:
+            self.boxes[row] = box
+            self.image_sizes[row] = image_size
+        if frame is not None:
+            self.frames[row] = frame
+
+    def flush(self):
+        for arr in (self.ids, self.scores, self.boxes, self.image_sizes, self.frames):
+            arr.flush()
+
+
+class ResultTableWriter:
+    """スキャン全体の結果テーブル（検索画像の行番号はスキャン開始時に確定する）"""
+
+    def __init__(self, output_dir, corpus_paths, search_root, top_k, cascade=False):
+        self.table_dir = os.path.join(output_dir, TABLE_DIR_NAME)
+        os.makedirs(self.table_dir, exist_ok=True)
+        _write_json(os.path.join(self.table_dir, "corpus_paths.json"), list(corpus_paths))
+        self.rows = {path: i for i, path in enumerate(corpus_paths)}
+        self.meta = {
+            'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'search_root': os.path.abspath(search_root),
+            'top_k': top_k,
+            # カスケード検索では通過しなかった画像は ResNet-50 の結果を持たない
+            'cascade': cascade,
+            'sets': {},
+        }
+        self.set_writers = {}
+
+    def add_set(self, name, target_dir, tolerance, target_paths, k):
+        writer = ResultTableSetWriter(
+            os.path.join(self.table_dir, name), len(self.rows), k, target_paths)
+        self.meta['sets'][name] = {'target_dir': target_dir, 'tolerance': tolerance, 'k': k}
+        self.set_writers[name] = writer
+        return writer
+
+    def close(self):
+        for writer in self.set_writers.values():
+            writer.flush()
+        _write_json(os.path.join(self.table_dir, "meta.json"), self.meta)
+
+
+def load_result_table(run_dir):
+    """保存済みの結果テーブルを読み込む（配列は読み取り専用のメモリマップ）"""
+    table_dir = os.path.join(run_dir, TABLE_DIR_NAME)
+    meta = _read_json(os.path.join(table_dir, "meta.json"))
+    table = {
+        'meta': meta,
+        'corpus_paths': _read_json(os.path.join(table_dir, "corpus_paths.json")),
+        'sets': {},
+    }
+    for name, set_meta in meta['sets'].items():
+        set_dir = os.path.join(table_dir, name)
+        table['sets'][name] = dict(
+            set_meta,
+            name=name,
+            target_paths=_read_json(os.path.join(set_dir, "target_paths.json")),
+            ids=np.load(os.path.join(set_dir, "ids.npy"), mmap_mode='r'),
+            scores=np.load(os.path.join(set_dir, "scores.npy"), mmap_mode='r'),
+            boxes=np.load(os.path.join(set_dir, "boxes.npy"), mmap_mode='r'),
+            image_sizes=np.load(os.path.join(set_dir, "image_sizes.npy"), mmap_mode='r'),
+            frames=np.load(os.path.join(set_dir, "frames.npy"), mmap_mode='r'),
+        )
+    return table
+
+
+def best_scores(table_set):
+    """検索済みの行番号と、その最高類似度"""
+    rows = np.flatnonzero(table_set['ids'][:, 0] >= 0)
+    return rows, np.asarray(table_set['scores'][rows, 0])
+
+
+def apply_threshold(table_set, corpus_paths, tolerance, top_k=1, max_results=None):
+    """閾値と件数を適用してスキャン時と同じ形式の結果リストを作る
+
+    top_k は1画像あたりに報告するTarget画像の数（1 = スキャン時と同じ最も類似な1件のみ）。
+    """
+    top_k = max(1, min(top_k, table_set['ids'].shape[1]))
+    ids = np.asarray(table_set['ids'][:, :top_k])
+    scores = np.asarray(table_set['scores'][:, :top_k])
+    rows, cols = np.nonzero((ids >= 0) & (scores >= tolerance))
+    results = []
+    for row, col in zip(rows, cols):
+        if max_results and len(results) >= max_results:
+            break
+        target_path = table_set['target_paths'][ids[row, col]]
+        result = {
+            'target_set': table_set['name'],
+            'target_image': os.path.basename(target_path),
+            'target_image_path': target_path,
+            'matched_path': corpus_paths[row],
+            'similarity': f"{scores[row, col]:.3f}",
+        }
+        box = table_set['boxes'][row]
+        if box[0] >= 0:
+            result['box'] = tuple(int(v) for v in box)
+            result['image_size'] = tuple(int(v) for v in table_set['image_sizes'][row])
+        if table_set['frames'][row] >= 0:
+            result['frame'] = int(table_set['frames'][row])
+        results.append(result)
+    return results
+
+
+def threshold_sweep(table_set, thresholds):
+    """各閾値でのマッチ数（最高類似度が閾値以上の検索画像数）をまとめて計算"""
+    _, best = best_scores(table_set)
+    best = np.sort(best)
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    return len(best) - np.searchsorted(best, thresholds, side='left')
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+実行履歴ストア（SQLite）
+
+各実行のパラメータ・処理時間・マッチ結果を output/results.sqlite3 に記録し、
+「この画像が最初にマッチしたのはいつか」「前回から新しく増えたマッチは何か」といった
+実行をまたいだ問い合わせをHTMLやログを読まずに行えるようにする。
+"""
+import json
+import os
+import sqlite3
+
+DB_FILE_NAME = "results.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,          -- 出力ディレクトリのタイムスタンプ（YYYYMMDD_HHMMSS）
+    started_at TEXT NOT NULL,         -- ISO 8601
+    finished_at TEXT,
+    search_root TEXT NOT NULL,
+    image_count INTEGER,
+    params TEXT,                      -- JSON
+    timings TEXT                      -- JSON（秒）
+);
+CREATE INDEX IF NOT EXISTS idx_runs_started_at ON runs (started_at);
+
+CREATE TABLE IF NOT EXISTS matches (
+    run_id TEXT NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    target_set TEXT NOT NULL,
+    corpus_path TEXT NOT NULL,
+    target_path TEXT NOT NULL,
+    similarity REAL NOT NULL,
+    box TEXT,                         -- タイル検索でマッチした領域（JSON、画像全体なら NULL）
+    frame INTEGER                     -- 複数フレーム画像でマッチしたフレーム番号（単一フレームなら NULL）
+);
+CREATE INDEX IF NOT EXISTS idx_matches_run ON matches (run_id, target_set, corpus_path, target_path);
+CREATE INDEX IF NOT EXISTS idx_matches_corpus ON matches (corpus_path, run_id);
+CREATE INDEX IF NOT EXISTS idx_matches_target ON matches (target_path, run_id);
+"""
+
+
+def default_db_path(script_dir):
+    return os.path.join(script_dir, "output", DB_FILE_NAME)
+
+
+def connect(db_path):
+    """ストアに接続（なければ作成）"""
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_run(conn, run_id, started_at, finished_at, search_root, image_count, params, timings, results):
+    """1回の実行を記録（同じ run_id があれば置き換える）"""
+    with conn:
+        conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        conn.execute(
+            "INSERT INTO runs (run_id, started_at, finished_at, search_root, image_count, params, timings) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (run_id, started_at, finished_at, os.path.abspath(search_root), image_count,
+             json.dumps(params, ensure_ascii=False), json.dumps(timings)),
+        )
+        conn.executemany(
+            "INSERT INTO matches (run_id, target_set, corpus_path, target_path, similarity, box, frame) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (run_id, result['target_set'], os.path.abspath(result['matched_path']),
+                 os.path.abspath(result['target_image_path']), float(result['similarity']),
+                 json.dumps(list(result['box'])) if result.get('box') else None, result.get('frame'))
+                for result in results
+            ],
+        )
+
+
+def list_runs(conn, limit=None):
+    sql = ("SELECT r.*, (SELECT COUNT(*) FROM matches m WHERE m.run_id = r.run_id) AS match_count "
+           "FROM runs r ORDER BY r.started_at DESC")
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return conn.execute(sql).fetchall()
+
+
+def get_run(conn, run_id):
+    return conn.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+
+
+def resolve_run(conn, ref):
+    """'latest' / 'previous' / タイムスタンプ から run_id を決める（見つからなければ None）"""
+    if ref in ("latest", "previous"):
+        offset = 0 if ref == "latest" else 1
+        row = conn.execute(
+            "SELECT run_id FROM runs ORDER BY started_at DESC LIMIT 1 OFFSET ?", (offset,)).fetchone()
+        return row['run_id'] if row else None
+    row = get_run(conn, ref)
+    return row['run_id'] if row else None
+
+
+def last_run_before(conn, date):
+    """指定日時（ISO 8601 の前方一致で比較）より前の最後の実行"""
+    row = conn.execute(
+        "SELECT run_id FROM runs WHERE started_at < ? ORDER BY started_at DESC LIMIT 1", (date,)).fetchone()
+    return row['run_id'] if row else None
+
+
+_MATCH_KEY = "target_set, corpus_path, target_path"
+
+
+def diff_runs(conn, run_a, run_b, target_set=None):
+    """2つの実行間のマッチの差分
+
+    new: run_b だけでマッチ / resolved: run_a だけでマッチ / persistent: 両方でマッチ
+    （マッチは Target画像セット・検索画像・Target画像 の組で比較する）
+    """
+    set_filter = " AND target_set = ?" if target_set else ""
+
+    def params(*run_ids):
+        out = []
+        for run_id in run_ids:
+            out.append(run_id)
+            if target_set:
+                out.append(target_set)
+        return out
+
+    def query(first, second, op):
+        rows = conn.execute(
+            f"SELECT {_MATCH_KEY} FROM matches WHERE run_id = ?{set_filter} "
+            f"{op} SELECT {_MATCH_KEY} FROM matches WHERE run_id = ?{set_filter} "
+            f"ORDER BY {_MATCH_KEY}",
+            params(first, second),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    return {
+        'new': query(run_b, run_a, "EXCEPT"),
+        'resolved': query(run_a, run_b, "EXCEPT"),
+        'persistent': query(run_a, run_b, "INTERSECT"),
+    }
+
+
+def match_history(conn, corpus_path):
+    """検索画像のマッチ履歴（古い順）。完全一致がなければパスの末尾で検索する"""
+    sql = ("SELECT m.*, r.started_at FROM matches m JOIN runs r ON r.run_id = m.run_id "
+           "WHERE m.corpus_path {} ORDER BY r.started_at, m.target_set")
+    rows = conn.execute(sql.format("= ?"), (os.path.abspath(corpus_path),)).fetchall()
+    if not rows:
+        rows = conn.execute(sql.format("LIKE ? ESCAPE '\\'"), ("%" + _escape_like(corpus_path),)).fetchall()
+    return rows
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
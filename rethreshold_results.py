@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+保存済みの検索結果テーブルから、再スキャンせずに閾値・件数を変えて再集計するスクリプト
+
+使用方法:
+    python rethreshold_results.py [タイムスタンプ] [--tolerance 0.90] [--top-k 1] [--max-results N]
+                                  [--set セット名] [--sweep 0.70 0.95 0.01] [--no-report]
+
+タイムスタンプ省略時は最新の実行結果を使用する。
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from result_table import TABLE_DIR_NAME, load_result_table, best_scores, apply_threshold, threshold_sweep
+# torch を読み込まないよう、レポート出力は report から直接使う
+from report import generate_html_report, print_similarity_statistics, report_name_for
+
+def find_latest_run(output_root):
+    """結果テーブルを持つ最新の実行結果ディレクトリ名"""
+    if not os.path.isdir(output_root):
+        return None
+    timestamps = sorted(
+        (name for name in os.listdir(output_root)
+         if re.fullmatch(r"\d{8}_\d{6}", name)
+         and os.path.isdir(os.path.join(output_root, name, TABLE_DIR_NAME))),
+        reverse=True,
+    )
+    return timestamps[0] if timestamps else None
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済みの検索結果を閾値・件数を変えて再集計します")
+    parser.add_argument("timestamp", nargs="?", help="実行結果のタイムスタンプ（省略時は最新）")
+    parser.add_argument("--tolerance", type=float, help="類似度の閾値（省略時はスキャン時の値）")
+    parser.add_argument("--top-k", type=int, default=1, help="1画像あたりに報告するTarget画像の数")
+    parser.add_argument("--max-results", type=int, help="最大結果数（セットごと）")
+    parser.add_argument("--set", dest="set_name", help="対象のTarget画像セット（省略時は全て）")
+    parser.add_argument("--sweep", type=float, nargs=3, metavar=("START", "STOP", "STEP"),
+                        help="閾値ごとのマッチ数を表示（例: --sweep 0.70 0.95 0.01）")
+    parser.add_argument("--no-report", action="store_true", help="HTMLレポートを再生成しない")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output_root = os.path.join(script_dir, "output")
+    timestamp = args.timestamp or find_latest_run(output_root)
+    if not timestamp:
+        print("❌ 結果テーブルを持つ実行結果が見つかりません")
+        sys.exit(1)
+    run_dir = os.path.join(output_root, timestamp)
+    if not os.path.isdir(os.path.join(run_dir, TABLE_DIR_NAME)):
+        print(f"❌ 結果テーブルが見つかりません: {os.path.join(run_dir, TABLE_DIR_NAME)}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    table = load_result_table(run_dir)
+    sets = table['sets']
+    if args.set_name:
+        if args.set_name not in sets:
+            print(f"❌ Target画像セットが見つかりません: {args.set_name}（{', '.join(sets)}）")
+            sys.exit(1)
+        sets = {args.set_name: sets[args.set_name]}
+
+    print("=" * 60)
+    print("🔁 Re-threshold saved results")
+    print("=" * 60)
+    print(f"   - Run: {timestamp}")
+    print(f"   - Search Root: {table['meta']['search_root']}")
+    print(f"   - Images: {len(table['corpus_paths'])}")
+    if table['meta'].get('cascade'):
+        print("   ⚠️  Cascade scan: only images that passed the cascade have ResNet-50 scores")
+    print("=" * 60)
+
+    all_sets = list(table['sets'].values())
+    for table_set in sets.values():
+        tolerance = args.tolerance if args.tolerance is not None else table_set['tolerance']
+        results = apply_threshold(
+            table_set, table['corpus_paths'], tolerance, top_k=args.top_k, max_results=args.max_results
+        )
+        print(f"\n📊 [{table_set['name']}] Matches at threshold {tolerance}: {len(results)}")
+
+        # 類似度の統計情報（スキャン時と同じ表示）
+        rows, best = best_scores(table_set)
+        print_similarity_statistics({
+            'name': table_set['name'],
+            'tolerance': tolerance,
+            'similarities': best,
+            'similarity_paths': [table['corpus_paths'][row] for row in rows],
+        })
+
+        if args.sweep:
+            sweep_start, sweep_stop, sweep_step = args.sweep
+            thresholds = np.arange(sweep_start, sweep_stop + sweep_step / 2, sweep_step)
+            counts = threshold_sweep(table_set, thresholds)
+            print(f"\n📉 Threshold sweep [{table_set['name']}]:")
+            for threshold, count in zip(thresholds, counts):
+                print(f"   - {threshold:.3f}: {count}")
+
+        # スキャン時のレポートは残し、閾値を付けた別名で出力する（例: image_similarity_faiss_report_tol0.9.html）
+        base_name, ext = os.path.splitext(report_name_for(table_set, all_sets))
+        report_name = f"{base_name}_tol{tolerance:g}{ext}"
+        # 同じ閾値で以前に再生成したレポートがあれば、マッチが0件でも0件のレポートで上書きする
+        # （古い内容が create_share_bundle.py で共有されないように）
+        if not args.no_report and (results or os.path.exists(os.path.join(run_dir, report_name))):
+            report_path = generate_html_report(
+                results,
+                tolerance=tolerance,
+                report_name=report_name,
+                target_set_name=table_set['name'] if len(all_sets) > 1 else None,
+                output_dir=run_dir,
+            )
+            if report_path:
+                print(f"✅ HTML report available: {os.path.abspath(report_path)}")
+
+    print(f"\n⏱️  Done in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    main()
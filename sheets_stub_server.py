@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Google Sheets API v4 のスタブサーバー（SheetsExporter の動作確認用）
+
+使用方法:
+    python sheets_stub_server.py [--port 8765] [--sheet-title シート1] [--throttle N] [--fail-puts-after N]
+    python sheets_stub_server.py --check
+
+サーバーとして起動した場合は、SHEETS_API_URL を http://127.0.0.1:8765/v4 にすると
+本物の Sheets の代わりに書き込み先として使える。--throttle で最初の N 回の書き込みに
+429（Retry-After は HTTP-date）を返し、--fail-puts-after で N 回成功した後の書き込みを
+400 で失敗させる。
+
+--check は一時ポートでスタブを起動し、SheetsExporter の書き込み・シート名のクオート・
+429 の再試行・失敗後に書き込まないことを確認する（失敗があれば終了コード 1）。
+"""
+import argparse
+import email.utils
+import json
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from result_exporters import SHEET_HEADERS, SheetsExporter
+
+# A1 表記の範囲（'シート名'!A1:C3 または シート名!A1:C3）
+A1_RANGE_PATTERN = re.compile(r"^(?:'((?:[^']|'')*)'|([\w.]+))!A(\d+):C(\d+)$")
+
+
+class StubState:
+    """スタブが受け付けたリクエストと、シートごとの書き込み内容"""
+
+    def __init__(self, sheet_title="シート1", throttle=0, fail_puts_after=None):
+        self.sheet_title = sheet_title
+        self.throttle = throttle  # 残りの 429 を返す回数
+        self.fail_puts_after = fail_puts_after  # この回数だけ書き込みが成功したら以降は 400
+        self.sheets = {}  # {シート名: {行番号: [値, ...]}}
+        self.requests = []  # [(メソッド, 範囲, ステータス), ...]
+        self.successful_puts = 0
+        self.lock = threading.Lock()
+
+    def put_attempts(self):
+        return [r for r in self.requests if r[0] == "PUT"]
+
+
+def parse_a1_range(range_name):
+    """A1 表記の範囲を (シート名, 開始行, 終了行) に分割（解釈できなければ None）"""
+    match = A1_RANGE_PATTERN.match(range_name)
+    if not match:
+        return None
+    quoted, plain, start_row, end_row = match.groups()
+    sheet_name = quoted.replace("''", "'") if quoted is not None else plain
+    return sheet_name, int(start_row), int(end_row)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None  # make_server で StubState を設定する
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body=None, headers=None):
+        payload = json.dumps(body or {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _values_range(self):
+        """/v4/spreadsheets/<id>/values/<範囲>[:clear] から範囲を取り出す"""
+        path = urllib.parse.urlsplit(self.path).path
+        _, _, encoded = path.partition("/values/")
+        return urllib.parse.unquote(encoded) if encoded else None
+
+    def do_GET(self):
+        state = self.state
+        with state.lock:
+            state.requests.append(("GET", None, 200))
+        self._send_json(200, {"sheets": [{"properties": {"title": state.sheet_title, "index": 0}}]})
+
+    def do_POST(self):
+        state = self.state
+        range_name = self._values_range()
+        self._read_json()
+        if not range_name or not range_name.endswith(":clear"):
+            self._send_json(404)
+            return
+        range_name = range_name[:-len(":clear")]
+        # シート名だけの範囲も A1 表記のクオート規則に従う
+        match = re.fullmatch(r"'((?:[^']|'')*)'|[\w.]+", range_name)
+        status = 200 if match else 400
+        with state.lock:
+            state.requests.append(("POST", range_name, status))
+            if match:
+                sheet_name = match.group(1).replace("''", "'") if match.group(1) is not None else range_name
+                state.sheets[sheet_name] = {}
+        self._send_json(status)
+
+    def do_PUT(self):
+        state = self.state
+        range_name = self._values_range()
+        body = self._read_json()
+        with state.lock:
+            if state.throttle > 0:
+                state.throttle -= 1
+                state.requests.append(("PUT", range_name, 429))
+                retry_at = email.utils.formatdate(time.time() + 2, usegmt=True)
+                self._send_json(429, {"error": {"status": "RESOURCE_EXHAUSTED"}}, {"Retry-After": retry_at})
+                return
+            if state.fail_puts_after is not None and state.successful_puts >= state.fail_puts_after:
+                state.requests.append(("PUT", range_name, 400))
+                self._send_json(400, {"error": {"status": "INVALID_ARGUMENT"}})
+                return
+            parsed = parse_a1_range(range_name or "")
+            values = body.get("values", [])
+            if parsed is None or body.get("range") != range_name or parsed[2] - parsed[1] + 1 != len(values):
+                state.requests.append(("PUT", range_name, 400))
+                self._send_json(400, {"error": {"message": f"Unable to parse range: {range_name}"}})
+                return
+            sheet_name, start_row, _ = parsed
+            rows = state.sheets.setdefault(sheet_name, {})
+            for offset, row in enumerate(values):
+                rows[start_row + offset] = row
+            state.successful_puts += 1
+            state.requests.append(("PUT", range_name, 200))
+        self._send_json(200, {"updatedRange": range_name, "updatedRows": len(values)})
+
+
+def make_server(port, state):
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def sheet_values(state, sheet_name):
+    rows = state.sheets.get(sheet_name, {})
+    return [rows[row] for row in sorted(rows)]
+
+
+def sample_results(count):
+    return [{'target_image': "logo.png", 'matched_path': f"img/{i}.png", 'similarity': 0.9} for i in range(count)]
+
+
+def run_scenario(name, state, exporter_kwargs, check):
+    """一時ポートでスタブを起動し、SheetsExporter で書き込んでから check(state, exporter, error, elapsed) を評価"""
+    server = make_server(0, state)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v4"
+    exporter = SheetsExporter("stub", base_url=base_url, backoff_base=0.01, timeout=5, **exporter_kwargs)
+    error = None
+    start = time.monotonic()
+    try:
+        exporter.open()
+        exporter.write(sample_results(5))
+        exporter.close()
+    except Exception as e:
+        error = e
+    elapsed = time.monotonic() - start
+    # 失敗の後に close() が呼ばれても書き込まないことを確認するため、例外後も close() する
+    if error is not None:
+        exporter.close()
+    server.shutdown()
+    server.server_close()
+    problem = check(state, exporter, error, elapsed)
+    print(f"{'❌' if problem else '✅'} {name}{f': {problem}' if problem else ''}")
+    return problem is None
+
+
+def check_default_sheet(state, exporter, error, elapsed):
+    if error is not None:
+        return f"unexpected error: {error}"
+    expected = [SHEET_HEADERS] + [[r['target_image'], r['matched_path'], r['similarity']] for r in sample_results(5)]
+    if sheet_values(state, "シート1") != expected:
+        return f"unexpected sheet contents: {state.sheets}"
+    return None
+
+
+def check_quoted_sheet(state, exporter, error, elapsed):
+    if error is not None:
+        return f"unexpected error: {error}"
+    if len(sheet_values(state, "Bob's results")) != 6:
+        return f"rows not written to the quoted sheet: {state.requests}"
+    return None
+
+
+def check_throttle(state, exporter, error, elapsed):
+    if error is not None:
+        return f"unexpected error: {error}"
+    statuses = [status for _, _, status in state.put_attempts()]
+    if statuses[:1] != [429] or len(sheet_values(state, "シート1")) != 6:
+        return f"429 was not retried: {statuses}"
+    # Retry-After（HTTP-date）に従い、再試行まで1秒以上待っていること
+    if elapsed < 1.0:
+        return f"retried after {elapsed:.2f}s, before Retry-After"
+    return None
+
+
+def check_failure(state, exporter, error, elapsed):
+    if error is None or not exporter.failed:
+        return "write failure was not reported"
+    statuses = [status for _, _, status in state.put_attempts()]
+    # ヘッダーと最初の2行は成功し、次の書き込みで失敗したら以降は何も送らない
+    if statuses != [200, 200, 400]:
+        return f"unexpected PUTs after the failure: {statuses}"
+    return None
+
+
+def run_checks():
+    results = [
+        run_scenario("first sheet, split into chunks", StubState(), {'max_rows_per_request': 2},
+                     check_default_sheet),
+        run_scenario("sheet name with a quote and a space", StubState(), {'sheet_name': "Bob's results"},
+                     check_quoted_sheet),
+        run_scenario("429 with Retry-After (HTTP-date)", StubState(throttle=1), {}, check_throttle),
+        run_scenario("no writes after a failed write", StubState(fail_puts_after=2),
+                     {'max_rows_per_request': 2}, check_failure),
+    ]
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Google Sheets API v4 のスタブサーバー")
+    parser.add_argument("--port", type=int, default=8765, help="待ち受けるポート")
+    parser.add_argument("--sheet-title", default="シート1", help="最初のシートの名前")
+    parser.add_argument("--throttle", type=int, default=0, help="最初の N 回の書き込みに 429 を返す")
+    parser.add_argument("--fail-puts-after", type=int, help="N 回成功した後の書き込みを 400 で失敗させる")
+    parser.add_argument("--check", action="store_true", help="SheetsExporter の動作確認を実行して終了")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if run_checks() else 1)
+
+    state = StubState(args.sheet_title, throttle=args.throttle, fail_puts_after=args.fail_puts_after)
+    server = make_server(args.port, state)
+    print(f"📡 Sheets stub listening: SHEETS_API_URL = \"http://127.0.0.1:{args.port}/v4\"")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for sheet_name in state.sheets:
+            print(f"   - {sheet_name}: {len(state.sheets[sheet_name])} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+検索対象ディレクトリを監視し、追加・更新された画像だけをその場で検索するスクリプト
+
+特徴抽出モデルとTarget画像セットのインデックスは起動時に1回だけ構築し、以降は
+ファイルの変更通知（watchdog があれば使用、なければ定期的なポーリング）で見つかった
+画像だけを特徴抽出して照合する。変更通知は WATCH_DEBOUNCE_SECONDS の間まとめてから
+処理し、マッチは見つかった時点で output/<ts>/matches.jsonl に追記する。
+
+使用方法:
+    python watch_search.py <検索対象ディレクトリ> [--poll]
+
+    --poll  watchdog がインストールされていても、ポーリングで監視する
+
+Ctrl+C で終了すると、監視中のマッチを実行履歴ストアに記録する。
+検索の設定（閾値・タイル検索・フレームサンプリング・除外ディレクトリなど）は
+image_similarity_faiss.py の設定をそのまま使う。
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from image_sources import is_archive, list_archive_images, iter_image_sources, order_for_streaming
+from result_exporters import create_exporters, ExportQueue
+import results_store
+from image_similarity_faiss import (
+    IMAGE_EXTENSIONS, MAX_IMAGE_FILE_SIZE, ENABLE_ARCHIVE_SEARCH, ENABLE_TILED_SEARCH, ENABLE_FRAME_SAMPLING,
+    TILE_BATCH_SIZE, EXPORT_FORMATS, ENABLE_RESULTS_STORE, SPREADSHEET_ID, SHEETS_CREDENTIALS_FILE,
+    SHEETS_API_URL, SHEETS_SHEET_NAME, FeatureExtractor, compute_embeddings_for_list, build_excluded_dirs,
+    resolve_target_sets, build_target_set, search_target_sets, run_params, get_output_dir,
+)
+
+# ========================================
+# 設定変数（ここで変更してください）
+# ========================================
+WATCH_DEBOUNCE_SECONDS = 2.0  # 最後の変更からこの秒数が経ったファイルを処理する（書き込み途中を避ける）
+WATCH_POLL_INTERVAL = 5.0  # ポーリング時にディレクトリを走査する間隔（秒）
+WATCH_MAX_BATCH = 256  # 1回にまとめて検索する画像の最大数
+
+# ========================================
+
+class ChangeQueue:
+    """変更されたパスと最後の変更時刻を保持し、落ち着いたものから取り出す"""
+
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.pending = {}  # {path: 最後の変更時刻}
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        with self.lock:
+            self.pending[path] = time.monotonic()
+
+    def pop_ready(self, limit):
+        """最後の変更から debounce 秒以上経ったパスを最大 limit 件取り出す"""
+        now = time.monotonic()
+        with self.lock:
+            ready = [path for path, changed in self.pending.items() if now - changed >= self.debounce][:limit]
+            for path in ready:
+                del self.pending[path]
+        return ready
+
+class PathFilter:
+    """監視対象のパスか判定（collect_search_image_paths と同じ除外ルール）"""
+
+    def __init__(self, excluded_dirs, skip_dirs):
+        self.excluded_dirs = excluded_dirs
+        self.skip_dirs = {os.path.abspath(d) for d in skip_dirs}
+
+    def is_excluded_dir(self, dir_path):
+        dir_path = os.path.abspath(dir_path)
+        return any(dir_path.startswith(excluded) for excluded in self.excluded_dirs) or dir_path in self.skip_dirs
+
+    def accepts(self, path):
+        name = os.path.basename(path)
+        if not (name.lower().endswith(IMAGE_EXTENSIONS) or (ENABLE_ARCHIVE_SEARCH and is_archive(name))):
+            return False
+        return not self.is_excluded_dir(os.path.dirname(path))
+
+def start_watchdog(search_root, path_filter, changes):
+    """watchdog でファイルの変更通知を受け取る（watchdog がない・監視を登録できなければ None）"""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        print("ℹ️ watchdog is not installed, falling back to polling (pip install watchdog)")
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def _add(self, path):
+            if path_filter.accepts(path):
+                changes.add(os.path.abspath(path))
+
+        def on_created(self, event):
+            if not event.is_directory:
+                self._add(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                self._add(event.src_path)
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                self._add(event.dest_path)
+
+    observer = Observer()
+    observer.daemon = True
+    try:
+        # 再帰監視は除外ディレクトリ（node_modules など）の中にも inotify の監視を登録するため、
+        # 大きなリポジトリでは max_user_watches の上限に達することがある
+        observer.schedule(Handler(), search_root, recursive=True)
+        observer.start()
+    except OSError as e:
+        print(f"⚠️  Failed to start watchdog ({e}), falling back to polling")
+        try:
+            observer.stop()
+        except Exception:
+            pass
+        return None
+    return observer
+
+def snapshot_files(search_root, path_filter):
+    """監視対象ファイルの {パス: (更新日時, サイズ)}"""
+    snapshot = {}
+    for root, dirs, files in os.walk(search_root):
+        # 除外ディレクトリの中には降りない
+        dirs[:] = [d for d in dirs if not path_filter.is_excluded_dir(os.path.join(root, d))]
+        for file in files:
+            path = os.path.abspath(os.path.join(root, file))
+            if not path_filter.accepts(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def start_polling(search_root, path_filter, changes, interval, stop_event):
+    """定期的にディレクトリを走査し、追加・更新されたファイルを changes に積む"""
+    def run():
+        previous = snapshot_files(search_root, path_filter)
+        while not stop_event.wait(interval):
+            current = snapshot_files(search_root, path_filter)
+            for path, stat in current.items():
+                if previous.get(path) != stat:
+                    changes.add(path)
+            previous = current
+
+    thread = threading.Thread(target=run, name="watch-poll", daemon=True)
+    thread.start()
+    return thread
+
+def expand_paths(paths):
+    """変更されたファイルを検索画像パスに展開（アーカイブは中の画像の仮想パス）"""
+    search_paths = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        if is_archive(path):
+            search_paths.extend(list_archive_images(path, IMAGE_EXTENSIONS))
+        else:
+            search_paths.append(path)
+    return order_for_streaming(search_paths)
+
+def search_paths(paths, extractor, target_sets):
+    """画像をまとめて特徴抽出し、全Target画像セットと照合してマッチを返す
+
+    監視中は全体の件数が決まらないので MAX_RESULTS は適用しない。
+    """
+    sources = iter_image_sources(paths, max_member_size=MAX_IMAGE_FILE_SIZE)
+    if not (ENABLE_TILED_SEARCH or ENABLE_FRAME_SAMPLING):
+        embeddings, valid_paths = compute_embeddings_for_list(paths, extractor, sources=sources)
+        if not valid_paths:
+            return []
+        return search_target_sets(target_sets, embeddings, valid_paths, max_results=None)
+
+    # タイル・フレームは TILE_BATCH_SIZE 枚ごとにまとめてバックボーンに通す
+    embeddings = []
+    valid_paths = []
+    owners = []
+    views = []
+    tensors = []
+    for path, data in sources:
+        image_tensors, image_views = extractor.prepare_views(path, data)
+        if image_tensors is None:
+            continue
+        owners.extend([len(valid_paths)] * len(image_views))
+        valid_paths.append(path)
+        views.extend(image_views)
+        tensors.append(image_tensors)
+        if sum(len(t) for t in tensors) >= TILE_BATCH_SIZE:
+            embeddings.append(extractor.embed_tensors(torch.cat(tensors)))
+            tensors.clear()
+    if tensors:
+        embeddings.append(extractor.embed_tensors(torch.cat(tensors)))
+    if not valid_paths:
+        return []
+    return search_target_sets(
+        target_sets, np.vstack(embeddings), valid_paths, owners=owners, views=views, max_results=None)
+
+def match_key(result):
+    return result['target_set'], result['matched_path']
+
+def update_matches(matches, searched_paths, results):
+    """検索し直した画像のマッチを最新の結果で置き換え、出力すべきマッチを返す
+
+    matches は {(セット名, 検索画像パス): 結果}。同じファイルが何度書き換えられても
+    画像ごとに最新のマッチだけを残し、以前と同じTarget画像へのマッチは出力し直さない。
+    書き換えでマッチしなくなった画像は matches から外す。
+    """
+    searched = set(searched_paths)
+    previous = {key: result for key, result in matches.items() if key[1] in searched}
+    for key in previous:
+        del matches[key]
+    new_results = []
+    for result in results:
+        key = match_key(result)
+        old = previous.get(key)
+        if old is None or old['target_image_path'] != result['target_image_path']:
+            new_results.append(result)
+        matches[key] = result
+    return new_results
+
+def main():
+    parser = argparse.ArgumentParser(description="検索対象ディレクトリを監視し、追加・更新された画像を検索します")
+    parser.add_argument("search_root", help="検索対象ディレクトリ")
+    parser.add_argument("--poll", action="store_true", help="watchdog を使わずにポーリングで監視する")
+    args = parser.parse_args()
+
+    search_root = os.path.abspath(args.search_root)
+    if not os.path.isdir(search_root):
+        print(f"❌ ディレクトリが見つかりません: {search_root}")
+        sys.exit(1)
+    started_at = datetime.now().isoformat(timespec='seconds')
+    os.environ.setdefault('OUTPUT_TIMESTAMP', datetime.now().strftime('%Y%m%d_%H%M%S'))
+    output_dir = get_output_dir()
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    # 特徴抽出モデルとインデックスは起動時に1回だけ構築して使い回す
+    extractor = FeatureExtractor()
+    target_set_configs = resolve_target_sets(script_dir)
+    target_sets = []
+    for config in target_set_configs:
+        target_set = build_target_set(config, extractor)
+        if target_set is not None:
+            target_sets.append(target_set)
+    if not target_sets:
+        print("❌ No usable target sets.")
+        sys.exit(1)
+
+    path_filter = PathFilter(
+        build_excluded_dirs(search_root), skip_dirs=[config['dir'] for config in target_set_configs])
+    changes = ChangeQueue(WATCH_DEBOUNCE_SECONDS)
+    stop_event = threading.Event()
+    observer = None if args.poll else start_watchdog(search_root, path_filter, changes)
+    if observer is None:
+        start_polling(search_root, path_filter, changes, WATCH_POLL_INTERVAL, stop_event)
+
+    # マッチは見つかった時点で matches.jsonl（と EXPORT_FORMATS の出力先）に追記する
+    export_formats = list(dict.fromkeys(["jsonl", *EXPORT_FORMATS]))
+    export_queue = ExportQueue(create_exporters(
+        export_formats, output_dir,
+        spreadsheet_id=SPREADSHEET_ID,
+        credentials_path=os.path.join(script_dir, SHEETS_CREDENTIALS_FILE),
+        sheets_api_url=SHEETS_API_URL,
+        sheet_name=SHEETS_SHEET_NAME,
+    ))
+
+    print("=" * 60)
+    print("👀 Watching for new and modified images")
+    print("=" * 60)
+    print(f"   - Search Root: {search_root}")
+    print(f"   - Mode: {'watchdog' if observer is not None else f'polling every {WATCH_POLL_INTERVAL}s'}")
+    print(f"   - Debounce: {WATCH_DEBOUNCE_SECONDS}s")
+    print(f"   - Output: {os.path.join(output_dir, 'matches.jsonl')}")
+    print("   Press Ctrl+C to stop.")
+    print("=" * 60)
+
+    image_count = 0
+    compute_time = 0.0
+    matches = {}  # {(セット名, 検索画像パス): 最新のマッチ}
+    try:
+        while True:
+            ready = changes.pop_ready(WATCH_MAX_BATCH)
+            if not ready:
+                time.sleep(min(0.5, WATCH_DEBOUNCE_SECONDS))
+                continue
+            paths = expand_paths(ready)
+            if not paths:
+                continue
+            compute_start = time.perf_counter()
+            try:
+                results = search_paths(paths, extractor, target_sets)
+            except Exception as e:
+                print(f"   ⚠️  Failed to search {len(paths)} changed images: {e}")
+                continue
+            finally:
+                compute_time += time.perf_counter() - compute_start
+                # 長時間の監視でメモリが増え続けないよう、セットごとの結果と統計用の類似度は保持しない
+                # （マッチは matches で画像ごとに最新のものだけを持つ）
+                for target_set in target_sets:
+                    target_set['results'].clear()
+                    target_set['similarities'].clear()
+                    target_set['similarity_paths'].clear()
+            new_results = update_matches(matches, paths, results)
+            image_count += len(paths)
+            export_queue.put(new_results)
+            print(f"🔍 [{datetime.now().strftime('%H:%M:%S')}] Searched {len(paths)} changed images, "
+                  f"{len(new_results)} new matches")
+    except KeyboardInterrupt:
+        print("\n🛑 Stopping watch...")
+    finally:
+        stop_event.set()
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        export_queue.close()
+
+    all_results = list(matches.values())
+    print(f"📊 Searched {image_count} images, {len(all_results)} matches "
+          f"(compute: {compute_time:.1f}s)")
+
+    # 監視中のマッチを1回の実行として実行履歴ストアに記録
+    if ENABLE_RESULTS_STORE:
+        try:
+            conn = results_store.connect(results_store.default_db_path(script_dir))
+            run_id = os.path.basename(output_dir)
+            params = dict(run_params(target_sets), watch=True)
+            results_store.record_run(
+                conn, run_id, started_at, datetime.now().isoformat(timespec='seconds'), search_root,
+                image_count, params, {'compute': compute_time}, all_results,
+            )
+            conn.close()
+            print(f"🗄️  Run recorded in results store: {run_id}")
+        except Exception as e:
+            print(f"⚠️  Failed to record run in results store: {e}")
+
+if __name__ == "__main__":
+    main()